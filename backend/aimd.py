@@ -0,0 +1,101 @@
+# Copyright (c) 2026 Taher AkbariSaeed
+import time
+
+# Results that point at the path (throttling, overload) rather than the IP
+CONGESTION_STATUSES = ('timeout', 'unreachable', 'tunnel_unreachable', 'error')
+
+
+class AimdController:
+    """Additive-increase / multiplicative-decrease limit for one pipeline stage.
+
+    Outcomes are judged in windows of `window` results. A window whose
+    failure rate jumps `fail_margin` above the running baseline, or whose
+    median latency inflates past `inflation` times the best median seen,
+    cuts the limit by `decrease`; any other window adds `increase`. Both
+    baselines follow calm windows down at once but only creep up, so a
+    stretch of mild congestion can't quietly become the new normal.
+    """
+
+    def __init__(self, name, start, min_limit=1, max_limit=None, window=None, increase=1, decrease=0.7, fail_margin=0.25, inflation=2.0):
+        self.name = name
+        self.limit = start
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max_limit or start
+        self.window = window or max(8, start)
+        self.increase = increase
+        self.decrease = decrease
+        self.fail_margin = fail_margin
+        self.inflation = inflation
+        self._fails = 0
+        self._latencies = []
+        self._count = 0
+        self.fail_base = None
+        self.latency_base = None
+        self.increases = 0
+        self.decreases = 0
+        self.last = None
+
+    def record(self, failed, latency=None):
+        """Feed one outcome; returns a decision dict when the window closes, else None."""
+        self._count += 1
+        if failed:
+            self._fails += 1
+        if latency is not None and latency >= 0:
+            self._latencies.append(latency)
+        if self._count < self.window:
+            return None
+        return self._decide()
+
+    def _decide(self):
+        fail_rate = self._fails / self._count
+        median = None
+        if self._latencies:
+            ordered = sorted(self._latencies)
+            median = ordered[len(ordered) // 2]
+        self._fails = 0
+        self._count = 0
+        self._latencies = []
+
+        reason = None
+        if self.fail_base is not None and fail_rate > self.fail_base + self.fail_margin:
+            reason = f"failures {fail_rate:.0%} vs {self.fail_base:.0%}"
+        elif median is not None and self.latency_base and median > self.latency_base * self.inflation:
+            reason = f"latency {median:.0f} vs {self.latency_base:.0f}"
+
+        old = self.limit
+        if reason:
+            self.limit = max(self.min_limit, int(self.limit * self.decrease))
+            self.decreases += 1
+            action = "decrease"
+        else:
+            # Only calm windows move the baselines
+            self.fail_base = fail_rate if self.fail_base is None else min(self.fail_base + 0.02, fail_rate)
+            if median is not None:
+                self.latency_base = median if not self.latency_base else min(self.latency_base * 1.05, median)
+            self.limit = min(self.max_limit, self.limit + self.increase)
+            if self.limit != old:
+                self.increases += 1
+            action = "increase"
+
+        self.last = {
+            "time": time.strftime('%H:%M:%S'),
+            "action": action,
+            "from": old,
+            "to": self.limit,
+            "fail_rate": round(fail_rate, 3),
+            "median": round(median, 1) if median is not None else None,
+            "reason": reason
+        }
+        return self.last
+
+    def stats(self):
+        return {
+            "limit": self.limit,
+            "min": self.min_limit,
+            "max": self.max_limit,
+            "increases": self.increases,
+            "decreases": self.decreases,
+            "fail_base": round(self.fail_base, 3) if self.fail_base is not None else None,
+            "latency_base": round(self.latency_base, 1) if self.latency_base else None,
+            "last": self.last
+        }
@@ -1,12 +1,18 @@
 # Copyright (c) 2026 Taher AkbariSaeed
+import hashlib
 import ipaddress
 import random
 import urllib.request
 import aiohttp
 import asyncio
 import re
+import time
 from datetime import datetime, timedelta
 from db import get_country_domains, save_country_domains
+from collections import OrderedDict
+from ip_sampler import RangePermutation, build_samplers, compile_ranges, format_ip
+from subnet_bandit import SubnetBandit
+from subnet_store import DeadBlockCache, SubnetStore, block_key, block_start, block_version
 
 # Fallback ranges if fetch fails
 CLOUDFLARE_RANGES = [
@@ -16,12 +22,19 @@ CLOUDFLARE_RANGES = [
     "104.24.0.0/14", "172.64.0.0/13", "131.0.72.0/22"
 ]
 
+# Blocks that keep coming back unreachable, per port; every generator skips them
+dead_subnets = DeadBlockCache()
+
 COMMUNITY_SCRAPE_URLS = [
     "https://raw.githubusercontent.com/vfarid/cf-ip-scanner/main/ipv4.txt",
     "https://raw.githubusercontent.com/ircfspace/scanner/main/ipv4.txt",
     "https://raw.githubusercontent.com/Epodon/v2ray-configs/main/Cloudflare-IPs.txt"
 ]
 
+def ranges_fingerprint(ranges):
+    """Order-independent id of a range set, e.g. to tell whether a refresh changed it."""
+    return hashlib.sha1("\n".join(sorted(set(ranges))).encode()).hexdigest()[:16]
+
 def update_cf_ranges():
     """Fetch Cloudflare IP ranges. Priority: BGP.he.net > Cloudflare Official > Hardcoded fallback."""
     global CLOUDFLARE_RANGES
@@ -70,6 +83,11 @@ def update_cf_ranges():
     # Priority 3: Hardcoded fallback (last resort)
     if new_ranges:
         CLOUDFLARE_RANGES = list(set(new_ranges))
+        # Compile now so the first scan doesn't pay for parsing
+        compile_ranges(CLOUDFLARE_RANGES)
+        # Only a different range set invalidates the (possibly restored) dead blocks
+        if dead_subnets.follow_ranges(ranges_fingerprint(CLOUDFLARE_RANGES)):
+            print("[SmartIP] CF ranges changed, cleared dead subnet cache")
         print(f"Updated CF Ranges: {len(CLOUDFLARE_RANGES)} total subnets")
     else:
         print("All fetch sources failed. Using hardcoded fallback ranges.")
@@ -202,14 +220,116 @@ async def fetch_custom_ips(source_type="custom_url", custom_url=None):
         print(f"Failed to fetch any custom IPs for {source_type}. Using hardcoded Cloudflare fallback ranges...")
         fetched_ranges = CLOUDFLARE_RANGES
         
-    
-    return list(set(fetched_ranges))
+    fetched_ranges = list(set(fetched_ranges))
+    compile_ranges(fetched_ranges)
+    return fetched_ranges
 
 class SmartIPGenerator:
-    def __init__(self, custom_ranges=None):
-        self.priority_subnets = set()
+    """Candidate IPs for Smart Discovery, each handed out at most once.
+
+    Exploration walks the ranges through ip_sampler (size-weighted, no
+    repeats). A SubnetBandit decides, per draw, whether to explore or to
+    continue a walk over a /24 (/120) that has produced good IPs, from
+    the outcomes fed back through report_result(); it also tilts the
+    exploration weights towards ranges with a better record. The walks
+    check each other, so an address is never produced twice. Blocks are
+    packed ints (subnet_store.block_key); the ones that produced good IPs
+    live in `priority_subnets`, a SubnetStore that forks share, and
+    blocks in `dead_subnets` for the probe's port are skipped. Without
+    custom ranges the generator follows the current CLOUDFLARE_RANGES.
+    """
+
+    # Exploration draws between re-drawing the bandit's range weights
+    STEER_EVERY = 64
+    # Probes awaiting an outcome whose origin (explore/exploit) is remembered
+    MAX_PENDING = 65536
+    # Arms the bandit draws for per decision, re-ranked every SHORTLIST_EVERY draws
+    ARMS_PER_DRAW = 32
+    SHORTLIST_EVERY = 256
+
+    def __init__(self, custom_ranges=None, priority_subnets=None):
+        self.priority_subnets = priority_subnets if priority_subnets is not None else SubnetStore()
         self.tried_count = 0
-        self.ranges = custom_ranges if custom_ranges else CLOUDFLARE_RANGES
+        self.skipped_dead = 0
+        self.custom_ranges = custom_ranges
+        self.bandit = SubnetBandit()
+        self._samplers = None
+        self._built_from = None
+        self._families = {}  # ip_version -> (families, their weights)
+        self._walks = {}  # block key -> RangePermutation over that block
+        self._spent = set()  # blocks whose walk is finished
+        self._block_ranges = {}
+        self._synced = None  # priority_subnets.version the bandit's arms match
+        self._pending = OrderedDict()  # ip -> True if it came from exploration
+        self._explore_draws = 0
+        self._shortlist = None  # (families, port, arm count, top arms) the bandit draws among
+        self._shortlist_age = 0
+
+    @property
+    def ranges(self):
+        return self.custom_ranges if self.custom_ranges else CLOUDFLARE_RANGES
+
+    def fork(self):
+        """A fresh walk over the same ranges, sharing what was learned about good subnets."""
+        return SmartIPGenerator(self.custom_ranges, self.priority_subnets)
+
+    def restart(self):
+        """Start a new pass over every range (and priority subnet) in a new order."""
+        self._samplers = None
+        self._families.clear()
+        self._walks.clear()
+        self._spent.clear()
+        self._shortlist = None
+
+    def _get_samplers(self):
+        ranges = self.ranges
+        if self._samplers is None or self._built_from is not ranges:
+            if self._built_from is not ranges:
+                # Range indices belong to the old table
+                self.bandit.ranges.clear()
+                self._block_ranges.clear()
+            self._samplers = build_samplers(ranges)
+            self._built_from = ranges
+            self._families.clear()
+        return self._samplers
+
+    def _families_for(self, samplers, ip_version):
+        cached = self._families.get(ip_version)
+        if cached is None:
+            families = [v for v in (4, 6) if v in samplers and ip_version != ("ipv6" if v == 4 else "ipv4")]
+            # Families keep the share their number of ranges gave them before
+            # weighting: by address count alone IPv6 would drown out IPv4
+            cached = (families, [len(samplers[v].starts) for v in families])
+            self._families[ip_version] = cached
+        return cached
+
+    def _sync_priority(self):
+        # Blocks in the store (seeded from history or found by other scans) become
+        # arms primed with their decayed score; evicted ones stop being arms
+        store = self.priority_subnets
+        if self._synced == store.version:
+            return
+        self._synced = store.version
+        self._shortlist = None
+        for key in list(self.bandit.blocks):
+            if key not in store:
+                self.bandit.drop_block(key)
+        now = time.time()
+        for key in store:
+            self.bandit.add_block(key, good=min(store.score(key, now), 3.0))
+
+    def _range_of_block(self, key):
+        if key not in self._block_ranges:
+            version = block_version(key)
+            sampler = self._samplers.get(version)
+            index = sampler.range_of(block_start(key)) if sampler else None
+            self._block_ranges[key] = (version, index) if index is not None else None
+        return self._block_ranges[key]
+
+    def _track(self, ip, explored):
+        self._pending[ip] = explored
+        if len(self._pending) > self.MAX_PENDING:
+            self._pending.popitem(last=False)
     
     def preseed_from_db(self, recommended_ips):
         """Pre-seed the scanner with historically successful subnets from the DB.
@@ -220,73 +340,136 @@ class SmartIPGenerator:
             if not ip:
                 continue
             try:
-                if "." in ip:
-                    network = ipaddress.ip_network(f"{ip}/24", strict=False)
-                    self.priority_subnets.add(str(network))
-                    seeded += 1
-                elif ":" in ip:
-                    network = ipaddress.ip_network(f"{ip}/120", strict=False)
-                    self.priority_subnets.add(str(network))
-                    seeded += 1
-            except:
-                pass
+                addr = ipaddress.ip_address(ip.strip())
+            except ValueError:
+                continue
+            self.priority_subnets.seed(block_key(addr.version, int(addr)))
+            seeded += 1
         if seeded:
             print(f"[SmartIP] Pre-seeded {seeded} subnets from DB recommendations")
         
-    def get_next_ip(self, ip_version="all"):
+    def get_next_ip(self, ip_version="all", port=0):
+        """Next untried IP to probe on `port` (0: the config's), or None once every range has been walked."""
         self.tried_count += 1
         
-        # Filter ranges based on version request
-        available_ranges = self.ranges
-        if ip_version == "ipv4":
-            available_ranges = [r for r in self.ranges if "." in r]
-        elif ip_version == "ipv6":
-            available_ranges = [r for r in self.ranges if ":" in r]
-            
-        if not available_ranges: return "1.1.1.1"
-
-        # Strategy: 40% chance to exploit good neighborhoods
-        if self.priority_subnets and random.random() < 0.4:
-            valid_priority = []
-            for s in self.priority_subnets:
-                 if ip_version == "ipv4" and ":" in s: continue
-                 if ip_version == "ipv6" and "." in s: continue
-                 valid_priority.append(s)
-            
-            if valid_priority:
-                subnet = random.choice(valid_priority)
-                try:
-                    net = ipaddress.ip_network(subnet)
-                    random_int = random.randint(0, net.num_addresses - 1)
-                    return str(net[random_int])
-                except:
-                    pass
+        samplers = self._get_samplers()
+        families, weights = self._families_for(samplers, ip_version)
+        if not families: return "1.1.1.1"
+
+        # Strategy: the bandit picks a good neighborhood or exploration
+        self._sync_priority()
+        candidates = self._arm_candidates(families, port)
+        if candidates:
+            key = self.bandit.choose(candidates, self._range_of_block)
+            if key is not None:
+                ip = self._next_block_ip(key, samplers)
+                if ip:
+                    self._track(ip, False)
+                    return ip
         
         # Default: Exploration
-        cidr = random.choice(available_ranges)
+        ip = self._next_range_ip(samplers, families, weights, port)
+        if ip:
+            self._track(ip, True)
+        return ip
+
+    def _arm_candidates(self, families, port):
+        # Ranking every arm per draw would cost milliseconds of loop time with
+        # a full store, so draws go to a shortlist that is re-ranked now and then
+        # (and as soon as an arm is added or dropped)
+        if (self._shortlist is None or self._shortlist[:3] != (families, port, len(self.bandit.blocks))
+                or self._shortlist_age >= self.SHORTLIST_EVERY):
+            eligible = [
+                k for k in self.bandit.blocks
+                if block_version(k) in families and k not in self._spent and not dead_subnets.is_dead(k, port)
+            ]
+            arms = self.bandit.shortlist(eligible, self._range_of_block, self.ARMS_PER_DRAW)
+            self._shortlist = (families, port, len(self.bandit.blocks), arms)
+            self._shortlist_age = 0
+        self._shortlist_age += 1
+        arms = self._shortlist[3]
+        live = [
+            k for k in arms
+            if k in self.bandit.blocks and k not in self._spent and not dead_subnets.is_dead(k, port)
+        ]
+        if len(live) < len(arms):
+            # Spent or dead arms leave the shortlist; refill it on the next draw
+            self._shortlist = self._shortlist[:3] + (live,)
+            if not live:
+                self._shortlist_age = self.SHORTLIST_EVERY
+        return live
+
+    def _next_range_ip(self, samplers, families, weights, port):
+        if self._explore_draws % self.STEER_EVERY == 0 and self.bandit.ranges:
+            for version in families:
+                samplers[version].set_factors(self.bandit.range_factors(version, len(samplers[version].starts)))
+        self._explore_draws += 1
+        while True:
+            version = families[0] if len(families) == 1 else random.choices(families, weights=weights)[0]
+            value = samplers[version].draw()
+            if value is None:
+                live = [v for v in families if not samplers[v].exhausted()]
+                if not live:
+                    return None
+                families, weights = live, [len(samplers[v].starts) for v in live]
+                continue
+            key = block_key(version, value)
+            walk = self._walks.get(key)
+            if walk and walk.emitted(value & 0xFF):
+                continue  # already handed out by a block walk
+            if dead_subnets.is_dead(key, port):
+                self.skipped_dead += 1
+                continue
+            return format_ip(version, value)
+
+    def _next_block_ip(self, key, samplers):
+        walk = self._walks.get(key)
+        if walk is None:
+            walk = self._walks[key] = RangePermutation(256)
+        version, first = block_version(key), block_start(key)
+        sampler = samplers.get(version)
+        offset = walk.next()
+        while offset is not None and sampler and sampler.emitted(first + offset):
+            offset = walk.next()  # exploration got there first
+        if offset is None:
+            self._spent.add(key)
+            return None
+        return format_ip(version, first + offset)
+
+    def report_result(self, ip, good, status=None, port=0):
+        """Feed a probe outcome back to the bandit and the dead-block cache.
+
+        Good IPs also mark their /24 (/120) as a priority subnet.
+        """
         try:
-            network = ipaddress.ip_network(cidr)
-            random_int = random.randint(0, int(network.num_addresses) - 1)
-            return str(network[random_int])
-        except:
-             return "1.1.1.1"
+            addr = ipaddress.ip_address(ip)
+        except ValueError:
+            return
+        version, value = addr.version, int(addr)
+        key = block_key(version, value)
+        sampler = (self._samplers or {}).get(version)
+        index = sampler.range_of(value) if sampler else None
+        explored = self._pending.pop(ip, None)
+        self.bandit.record(good, key, (version, index) if index is not None else None, explored)
+        status = status or ("ok" if good else None)
+        if status:
+            dead_subnets.record(key, port, status)
+        if good:
+            self.priority_subnets.add(key)
 
     def report_success(self, ip):
-        try:
-            if "." in ip:
-                network = ipaddress.ip_network(f"{ip}/24", strict=False)
-                self.priority_subnets.add(str(network))
-            else:
-                 network = ipaddress.ip_network(f"{ip}/120", strict=False)
-                 self.priority_subnets.add(str(network))
-        except:
-             pass
+        self.report_result(ip, True)
 
 # Default global generator
 smart_generator = SmartIPGenerator()
 
 def get_smart_ip(ip_version="all"):
-    return smart_generator.get_next_ip(ip_version)
+    ip = smart_generator.get_next_ip(ip_version)
+    if ip is None:
+        # The shared generator outlives scans; once it has seen everything, go round again
+        smart_generator.restart()
+        ip = smart_generator.get_next_ip(ip_version)
+    return ip
 
 def report_good_ip(ip):
     smart_generator.report_success(ip)
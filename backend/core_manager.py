@@ -1,4 +1,6 @@
 # Copyright (c) 2026 Taher AkbariSaeed
+import asyncio
+import json
 import os
 import urllib.request
 import zipfile
@@ -6,6 +8,7 @@ import subprocess
 import platform
 import stat
 import sys
+import time
 
 APP_DIR = os.path.join(os.path.expanduser("~"), ".antigravity_scanner")
 
@@ -22,6 +25,9 @@ else:  # Linux / Android
     _XRAY_DL_URL = "https://github.com/XTLS/Xray-core/releases/download/v26.2.6/Xray-linux-64.zip"
 
 XRAY_DIR = os.path.join(APP_DIR, "xray_core")
+
+# How configs reach Xray: "stdin" (no file at all), "tmpfs" (RAM-backed temp file) or "file" (APP_DIR)
+XRAY_CONFIG_MODE = os.environ.get('XRAY_CONFIG_MODE', 'stdin').lower()
 XRAY_EXE = os.path.join(XRAY_DIR, _XRAY_BINARY)
 
 def download_xray():
@@ -81,3 +87,383 @@ def get_xray_path():
                 _ensure_executable(resources)
             return os.path.abspath(resources)
     return os.path.abspath(XRAY_EXE)
+
+def kill_process_tree(process):
+    """Kill an Xray child process and anything it spawned."""
+    import psutil
+    try:
+        parent = psutil.Process(process.pid)
+        for child in parent.children(recursive=True):
+            child.kill()
+        parent.kill()
+        parent.wait(timeout=2)
+    except psutil.NoSuchProcess:
+        pass
+    except Exception:
+        try:
+            process.terminate()
+            process.wait(timeout=1)
+        except:
+            pass
+
+def _process_exited(process):
+    if process is None:
+        return False
+    if hasattr(process, "poll"):
+        return process.poll() is not None
+    return process.returncode is not None
+
+async def wait_for_port(port, process=None, timeout=5.0, socks=False):
+    """Wait until a local Xray inbound accepts connections (core is listening).
+
+    Retries with a short backoff (20 ms growing to 200 ms) and gives up as
+    soon as the process exits. With socks=True the inbound must also answer
+    a SOCKS5 greeting, so the handler behind the socket is known to be up.
+    This says nothing about the upstream; callers probe that separately.
+    """
+    deadline = time.monotonic() + timeout
+    delay = 0.02
+    while True:
+        if _process_exited(process):
+            return False
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection("127.0.0.1", port), timeout=0.5)
+            try:
+                ok = True
+                if socks:
+                    writer.write(b"\x05\x01\x00")
+                    await writer.drain()
+                    ok = await asyncio.wait_for(reader.readexactly(2), timeout=0.5) == b"\x05\x00"
+            finally:
+                writer.close()
+            if ok:
+                return True
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+            pass
+        if time.monotonic() + delay > deadline:
+            return False
+        # Wakes early when a reaped child prints its "started" line
+        await reaper.wait_started(process, delay)
+        delay = min(delay * 1.5, 0.2)
+
+class _XrayChild:
+    def __init__(self, process, label, persistent=False, config_path=None):
+        self.process = process
+        self.label = label
+        self.persistent = persistent
+        self.config_path = config_path
+        self.spawned_at = time.monotonic()
+        self.started = asyncio.Event()
+        self.drain_task = None
+        self.reaping = False
+
+class XrayReaper:
+    """Central owner of Xray child processes.
+
+    Children are killed and collected on one background task, so callers
+    never block the event loop on wait(). Their stdout/stderr is drained
+    continuously (and watched for the "started" line) so a full pipe can't
+    stall a core, and children that outlive `leak_after` seconds without
+    being reaped, or refuse to die, are reported as leaked. Persistent
+    children (engine cores, tunnels) are exempt from the age check.
+    """
+
+    def __init__(self, leak_after=600.0, kill_timeout=2.0):
+        self.leak_after = leak_after
+        self.kill_timeout = kill_timeout
+        self._children = {}  # pid -> _XrayChild
+        self._queue = None
+        self._task = None
+        self._reported = set()
+        self.stats = {'spawned': 0, 'reaped': 0, 'exited': 0, 'leaked': 0}
+
+    def track(self, process, label="", persistent=False, config_path=None):
+        child = _XrayChild(process, label, persistent, config_path)
+        self._children[process.pid] = child
+        self.stats['spawned'] += 1
+        if process.stdout is not None:
+            child.drain_task = asyncio.create_task(self._drain(child))
+        self._ensure_task()
+        return child
+
+    def reap(self, process):
+        """Schedule a child to be killed and collected; never blocks."""
+        if process is None:
+            return
+        child = self._children.get(process.pid)
+        if child is None:
+            child = _XrayChild(process, "untracked")
+            self._children[process.pid] = child
+        if child.reaping:
+            return
+        child.reaping = True
+        self._ensure_task()
+        self._queue.put_nowait(child)
+
+    async def reap_all(self):
+        for child in list(self._children.values()):
+            self.reap(child.process)
+        if self._queue is not None:
+            await self._queue.join()
+
+    async def wait_started(self, process, timeout):
+        child = self._children.get(process.pid) if process is not None else None
+        if child is None or child.started.is_set():
+            await asyncio.sleep(timeout)
+            return
+        try:
+            await asyncio.wait_for(child.started.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def leaked(self):
+        now = time.monotonic()
+        return [
+            {"pid": pid, "label": c.label, "age": round(now - c.spawned_at)}
+            for pid, c in self._children.items()
+            if not c.reaping and not c.persistent and now - c.spawned_at > self.leak_after
+        ]
+
+    def _ensure_task(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _drain(self, child):
+        stream = child.process.stdout
+        try:
+            while True:
+                line = await stream.readline()
+                if not line:
+                    break
+                if not child.started.is_set() and b" started" in line:
+                    child.started.set()
+        except Exception:
+            pass
+        # EOF: the child exited (or was killed); collect it if nobody asked to
+        if not child.reaping:
+            try:
+                await child.process.wait()
+            except Exception:
+                pass
+            if self._children.pop(child.process.pid, None) is not None:
+                self.stats['exited'] += 1
+                _remove_config(child.config_path)
+
+    async def _run(self):
+        while True:
+            try:
+                child = await asyncio.wait_for(self._queue.get(), timeout=60)
+            except asyncio.TimeoutError:
+                self._report_leaks()
+                continue
+            try:
+                await self._kill(child)
+            finally:
+                self._queue.task_done()
+
+    async def _kill(self, child):
+        process = child.process
+        if process.returncode is None:
+            try:
+                process.kill()
+            except ProcessLookupError:
+                pass
+        try:
+            await asyncio.wait_for(process.wait(), timeout=self.kill_timeout)
+        except asyncio.TimeoutError:
+            # Stubborn child: fall back to a psutil tree kill off the event loop
+            await asyncio.to_thread(kill_process_tree, process)
+            if process.returncode is None:
+                self.stats['leaked'] += 1
+                print(f"[XrayReaper] WARNING: failed to kill Xray pid {process.pid} ({child.label})")
+        if child.drain_task:
+            child.drain_task.cancel()
+        _remove_config(child.config_path)
+        self._children.pop(process.pid, None)
+        self.stats['reaped'] += 1
+
+    def _report_leaks(self):
+        for leak in self.leaked():
+            if leak["pid"] in self._reported:
+                continue
+            self._reported.add(leak["pid"])
+            self.stats['leaked'] += 1
+            print(f"[XrayReaper] WARNING: Xray pid {leak['pid']} ({leak['label']}) alive for {leak['age']}s without being reaped")
+
+# Shared reaper for every Xray child the backend starts
+reaper = XrayReaper()
+
+def serialize_config(config):
+    """Compact JSON for Xray; nobody reads these configs but the core."""
+    return json.dumps(config, separators=(",", ":")).encode()
+
+def _config_dir():
+    # RAM-backed directories first so config churn never touches eMMC / AV-scanned disks
+    candidates = ["/dev/shm"]
+    if hasattr(os, "getuid"):
+        candidates.append(f"/run/user/{os.getuid()}")
+    for d in candidates:
+        if os.path.isdir(d) and os.access(d, os.W_OK):
+            return d
+    os.makedirs(APP_DIR, exist_ok=True)
+    return APP_DIR
+
+def write_config_file(data, label="xray"):
+    safe = "".join(c if c.isalnum() else "_" for c in label)[:40]
+    directory = _config_dir() if XRAY_CONFIG_MODE != "file" else APP_DIR
+    path = os.path.join(directory, f"cfscan_{safe}_{os.getpid()}_{time.monotonic_ns()}.json")
+    with open(path, "wb") as f:
+        f.write(data)
+    return path
+
+def _remove_config(path):
+    if path:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def _creationflags():
+    # Hide terminal window on Windows Pyinstaller builds
+    return subprocess.CREATE_NO_WINDOW if os.name == 'nt' else 0
+
+class _PipeWriter:
+    """asyncio StreamWriter stand-in over a blocking pipe; writes happen on drain()."""
+
+    def __init__(self, pipe):
+        self._pipe = pipe
+        self._buffer = bytearray()
+
+    def write(self, data):
+        self._buffer += data
+
+    async def drain(self):
+        data, self._buffer = bytes(self._buffer), bytearray()
+        await asyncio.to_thread(self._pipe.write, data)
+        await asyncio.to_thread(self._pipe.flush)
+
+    def close(self):
+        self._pipe.close()
+
+
+class _PopenProcess:
+    """asyncio.subprocess.Process look-alike over subprocess.Popen.
+
+    Used when the running loop can't spawn children (Windows selector loops,
+    e.g. uvicorn --reload): stdout is not piped, so the reaper has nothing
+    to drain, and waits poll off the event loop.
+    """
+
+    def __init__(self, popen):
+        self._popen = popen
+        self.pid = popen.pid
+        self.stdin = _PipeWriter(popen.stdin) if popen.stdin is not None else None
+        self.stdout = None
+
+    @property
+    def returncode(self):
+        return self._popen.poll()
+
+    def kill(self):
+        self._popen.kill()
+
+    def terminate(self):
+        self._popen.terminate()
+
+    async def wait(self):
+        while self._popen.poll() is None:
+            await asyncio.sleep(0.05)
+        return self._popen.returncode
+
+    async def communicate(self, input=None):
+        return await asyncio.to_thread(self._popen.communicate, input)
+
+
+# Set once the loop has refused asyncio subprocesses; later spawns go straight to Popen
+_ASYNC_SUBPROCESS = True
+
+async def create_child(*cmd, stdin=None, stdout=None, stderr=None):
+    """Start a child as an asyncio subprocess, or a _PopenProcess where the loop can't."""
+    global _ASYNC_SUBPROCESS
+    if _ASYNC_SUBPROCESS:
+        try:
+            return await asyncio.create_subprocess_exec(
+                *cmd, stdin=stdin, stdout=stdout, stderr=stderr, creationflags=_creationflags()
+            )
+        except NotImplementedError:
+            print("[Xray] Event loop has no subprocess support; using blocking Popen children")
+            _ASYNC_SUBPROCESS = False
+    # Nothing drains the child's output on this path, so it must not fill a pipe
+    if stdout == subprocess.PIPE and stderr != subprocess.PIPE:
+        stdout = stderr = subprocess.DEVNULL
+    return _PopenProcess(subprocess.Popen(list(cmd), stdin=stdin, stdout=stdout, stderr=stderr, creationflags=_creationflags()))
+
+async def spawn_xray(config, label="", persistent=False):
+    """Start an Xray core from a config dict as an asyncio child owned by the shared reaper.
+
+    The config is fed over stdin (`xray run -config stdin:`) so no file is
+    written; if stdin can't be used it goes to a RAM-backed temp file that
+    the reaper deletes with the child.
+    """
+    global XRAY_CONFIG_MODE
+    data = serialize_config(config)
+    if XRAY_CONFIG_MODE == "stdin":
+        process = await create_child(
+            get_xray_path(), "run", "-config", "stdin:",
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT
+        )
+        # Owned by the reaper before the first await, so a cancelled spawn can't leak it
+        reaper.track(process, label, persistent)
+        try:
+            process.stdin.write(data)
+            await process.stdin.drain()
+            process.stdin.close()
+            return process
+        except (BrokenPipeError, ConnectionResetError) as e:
+            print(f"[Xray] Config over stdin failed ({e}); switching to tmpfs config files")
+            XRAY_CONFIG_MODE = "tmpfs"
+            reaper.reap(process)
+        except asyncio.CancelledError:
+            reaper.reap(process)
+            raise
+
+    config_path = write_config_file(data, label)
+    process = await create_child(
+        get_xray_path(), "run", "-c", config_path,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT
+    )
+    reaper.track(process, label, persistent, config_path)
+    return process
+
+def popen_xray(config, label=""):
+    """Blocking counterpart of spawn_xray for long-lived helpers (DB tunnel).
+
+    Returns (process, config_path); config_path is None when the config went
+    over stdin, otherwise the caller deletes it after stopping the process.
+    """
+    global XRAY_CONFIG_MODE
+    data = serialize_config(config)
+    if XRAY_CONFIG_MODE == "stdin":
+        process = subprocess.Popen(
+            [get_xray_path(), "run", "-config", "stdin:"], stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, creationflags=_creationflags()
+        )
+        try:
+            process.stdin.write(data)
+            process.stdin.close()
+            return process, None
+        except (BrokenPipeError, ConnectionResetError) as e:
+            print(f"[Xray] Config over stdin failed ({e}); switching to tmpfs config files")
+            XRAY_CONFIG_MODE = "tmpfs"
+            process.kill()
+            process.wait(timeout=1)
+
+    config_path = write_config_file(data, label)
+    process = subprocess.Popen(
+        [get_xray_path(), "run", "-c", config_path],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, creationflags=_creationflags()
+    )
+    return process, config_path
@@ -1,11 +1,10 @@
 # Copyright (c) 2026 Taher AkbariSaeed
-import json
-import subprocess
 import asyncio
 import os
 import sys
 import atexit
-from core_manager import get_xray_path, APP_DIR
+from core_manager import popen_xray
+from port_pool import reserve_port, release_port
 import urllib.parse
 from dotenv import load_dotenv
 
@@ -21,6 +20,9 @@ if os.path.exists(_env_path):
     load_dotenv(_env_path)
 
 db_xray_process = None
+db_config_path = None  # Only set when the config had to go to a temp file instead of stdin
+db_tunnel_port = None
+DB_TUNNEL_PORT = 33060  # Preferred local port; another free port is used if it's taken
 
 def generate_proxy_config(vless_data, local_port, remote_address, remote_port):
     params = vless_data.get("params", {})
@@ -86,7 +88,7 @@ def generate_proxy_config(vless_data, local_port, remote_address, remote_port):
 import psutil
 
 def stop_db_tunnel():
-    global db_xray_process
+    global db_xray_process, db_tunnel_port, db_config_path
     if db_xray_process:
         try:
             parent = psutil.Process(db_xray_process.pid)
@@ -97,29 +99,31 @@ def stop_db_tunnel():
         except:
             pass
         db_xray_process = None
+    if db_config_path:
+        try:
+            os.remove(db_config_path)
+        except OSError:
+            pass
+        db_config_path = None
+    if db_tunnel_port is not None:
+        release_port(db_tunnel_port)
+        db_tunnel_port = None
 
-def start_db_tunnel(vless_parts, target_db_host=None, target_db_port=3306, local_port=33060):
-    global db_xray_process
+def start_db_tunnel(vless_parts, target_db_host=None, target_db_port=3306, local_port=None):
+    """Start the DB tunnel and return the local port it listens on."""
+    global db_xray_process, db_tunnel_port, db_config_path
     if target_db_host is None:
         target_db_host = os.environ.get('DB_HOST', '')
     
     stop_db_tunnel()
     
-    config = generate_proxy_config(vless_parts, local_port, target_db_host, target_db_port)
-    config_path = os.path.join(APP_DIR, "db_proxy_config.json")
+    local_port = reserve_port(preferred=local_port or DB_TUNNEL_PORT)
+    db_tunnel_port = local_port
     
-    with open(config_path, "w") as f:
-        json.dump(config, f, indent=2)
-        
-    xray_path = get_xray_path()
-    
-    # Hide terminal window on Windows Pyinstaller builds
-    creationflags = 0
-    if os.name == 'nt':
-        creationflags = subprocess.CREATE_NO_WINDOW
-        
-    db_xray_process = subprocess.Popen([xray_path, "-c", config_path], stdout=subprocess.PIPE, stderr=subprocess.PIPE, creationflags=creationflags)
+    config = generate_proxy_config(vless_parts, local_port, target_db_host, target_db_port)
+    # Config goes over stdin (tmpfs file fallback); output is discarded so the pipe can't fill up
+    db_xray_process, db_config_path = popen_xray(config, label="db_tunnel")
     
-    return True
+    return local_port
 
 atexit.register(stop_db_tunnel)
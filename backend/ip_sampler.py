@@ -0,0 +1,211 @@
+# Copyright (c) 2026 Taher AkbariSaeed
+import bisect
+import ipaddress
+import itertools
+import random
+from array import array
+from collections import OrderedDict
+
+_ROUNDS = 4
+_MIX = 0x9E3779B97F4A7C15
+
+
+class RangePermutation:
+    """Visits every offset in [0, size) exactly once, in a keyed random order.
+
+    A small Feistel network over the next even bit width, cycle-walked back
+    into range, so the state is a few keys and a counter however large the
+    range is. Being a bijection it can also be run backwards, which answers
+    "has this offset been handed out yet?" without remembering any of them.
+    """
+
+    def __init__(self, size, rng=random):
+        self.size = size
+        self.half = max(1, ((size - 1).bit_length() + 1) // 2)
+        self.mask = (1 << self.half) - 1
+        self.width_mask = (1 << max(64, 2 * self.half)) - 1
+        self.keys = [rng.getrandbits(64) for _ in range(_ROUNDS)]
+        self.position = 0
+
+    def _f(self, value, key):
+        mixed = ((value ^ key) * _MIX) & self.width_mask
+        return (mixed ^ (mixed >> 29)) & self.mask
+
+    def _encrypt(self, x):
+        # _f inlined: this is the hot loop of candidate generation
+        half, mask, width = self.half, self.mask, self.width_mask
+        left, right = x >> half, x & mask
+        for key in self.keys:
+            mixed = ((right ^ key) * _MIX) & width
+            left, right = right, left ^ ((mixed ^ (mixed >> 29)) & mask)
+        return (left << half) | right
+
+    def _decrypt(self, y):
+        left, right = y >> self.half, y & self.mask
+        for key in reversed(self.keys):
+            left, right = right ^ self._f(left, key), left
+        return (left << self.half) | right
+
+    def permute(self, index):
+        x = self._encrypt(index)
+        while x >= self.size:
+            x = self._encrypt(x)
+        return x
+
+    def unpermute(self, offset):
+        x = self._decrypt(offset)
+        while x >= self.size:
+            x = self._decrypt(x)
+        return x
+
+    def exhausted(self):
+        return self.position >= self.size
+
+    def next(self):
+        """Next offset of the walk, or None once all of them were visited."""
+        if self.position >= self.size:
+            return None
+        offset = self.permute(self.position)
+        self.position += 1
+        return offset
+
+    def emitted(self, offset):
+        return 0 <= offset < self.size and self.unpermute(offset) < self.position
+
+
+def format_ipv4(value):
+    """Dotted quad for an int, without going through ipaddress objects."""
+    return f"{value >> 24}.{(value >> 16) & 255}.{(value >> 8) & 255}.{value & 255}"
+
+
+def format_ip(version, value):
+    return format_ipv4(value) if version == 4 else str(ipaddress.IPv6Address(value))
+
+
+class RangeTable:
+    """A CIDR list compiled once into per-family parallel arrays.
+
+    For each family `families[version]` holds the collapsed, sorted range
+    `starts`, their `sizes` and the running sum `cum` of sizes, so a
+    size-weighted pick and "which range holds this address" are one bisect
+    each and no CIDR string is parsed again. IPv4 uses compact unsigned
+    arrays; IPv6 values need Python ints. Build through compile_ranges().
+    """
+
+    def __init__(self, cidrs):
+        by_family = {4: [], 6: []}
+        for cidr in cidrs:
+            try:
+                net = ipaddress.ip_network(cidr.strip(), strict=False)
+            except (ValueError, AttributeError):
+                continue
+            by_family[net.version].append(net)
+        self.families = {}
+        for version, nets in by_family.items():
+            if not nets:
+                continue
+            collapsed = sorted(ipaddress.collapse_addresses(nets))
+            starts = [int(net.network_address) for net in collapsed]
+            sizes = [net.num_addresses for net in collapsed]
+            cum = list(itertools.accumulate(sizes))
+            if version == 4:
+                starts, sizes, cum = array('Q', starts), array('Q', sizes), array('Q', cum)
+            self.families[version] = (starts, sizes, cum)
+
+    def count(self, version):
+        family = self.families.get(version)
+        return len(family[0]) if family else 0
+
+
+# Recently compiled lists; scans over the same source share one table
+_tables = OrderedDict()
+_TABLE_CACHE = 8
+
+def compile_ranges(cidrs):
+    key = tuple(cidrs)
+    table = _tables.get(key)
+    if table is None:
+        table = RangeTable(key)
+        _tables[key] = table
+        if len(_tables) > _TABLE_CACHE:
+            _tables.popitem(last=False)
+    else:
+        _tables.move_to_end(key)
+    return table
+
+
+class RangeSampler:
+    """Draws addresses of one family of a RangeTable, never the same one twice.
+
+    Each draw picks a range with probability proportional to its address
+    count (a /13 is 512 times likelier than a /22) and takes that range's
+    next permuted offset. set_factors() can scale those weights per range
+    (the subnet bandit steers exploration that way). Permutations are
+    created on a range's first draw and the table's weights are shared
+    until a range runs out or factors are set, after which the sampler
+    keeps its own for the ranges still live. Addresses are ints.
+    """
+
+    def __init__(self, table, version, rng=None):
+        self.rng = rng or random.Random()
+        self.starts, self.sizes, self._table_cum = table.families[version]
+        self._perms = {}
+        self._factors = None
+        self._live = None  # None: every range, indexed as in the table
+        self._cum = self._table_cum
+        self._total = self._cum[-1]
+
+    def _reweigh(self):
+        live = [i for i in range(len(self.starts)) if not (i in self._perms and self._perms[i].exhausted())]
+        if self._factors is None and len(live) == len(self.starts):
+            self._live, self._cum = None, self._table_cum
+        elif self._factors is None:
+            self._live = live
+            self._cum = list(itertools.accumulate(self.sizes[i] for i in live))
+        else:
+            self._live = live
+            self._cum = list(itertools.accumulate(self.sizes[i] * self._factors[i] for i in live))
+        self._total = self._cum[-1] if self._cum else 0
+
+    def set_factors(self, factors):
+        """Weigh range i by sizes[i] * factors[i]; None goes back to plain size weighting."""
+        self._factors = factors
+        self._reweigh()
+
+    def range_of(self, value):
+        """Index of the range holding `value`, or None."""
+        index = bisect.bisect_right(self.starts, value) - 1
+        if index >= 0 and value - self.starts[index] < self.sizes[index]:
+            return index
+        return None
+
+    def exhausted(self):
+        return self._total == 0
+
+    def draw(self):
+        """Next address, or None when every range has been walked."""
+        while self._total:
+            # Float rounding can land exactly on the total
+            pick = min(bisect.bisect_right(self._cum, self.rng.random() * self._total), len(self._cum) - 1)
+            index = self._live[pick] if self._live is not None else pick
+            perm = self._perms.get(index)
+            if perm is None:
+                perm = self._perms[index] = RangePermutation(self.sizes[index], self.rng)
+            offset = perm.next()
+            if perm.exhausted():
+                self._reweigh()
+            if offset is not None:
+                return self.starts[index] + offset
+        return None
+
+    def emitted(self, value):
+        """Whether `value` was already handed out by this sampler."""
+        index = bisect.bisect_right(self.starts, value) - 1
+        perm = self._perms.get(index) if index >= 0 else None
+        return perm is not None and perm.emitted(value - self.starts[index])
+
+
+def build_samplers(cidrs, rng=None):
+    """Per-family RangeSamplers ({4: ..., 6: ...}) over the compiled table for `cidrs`."""
+    table = compile_ranges(cidrs)
+    return {version: RangeSampler(table, version, rng) for version in table.families}
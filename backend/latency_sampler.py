@@ -0,0 +1,86 @@
+# Copyright (c) 2026 Taher AkbariSaeed
+import math
+
+
+def percentile(sorted_values, q):
+    """Linear-interpolated percentile of an already sorted list, q in [0, 100]."""
+    if not sorted_values:
+        return -1
+    pos = (len(sorted_values) - 1) * q / 100.0
+    lo = int(math.floor(pos))
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (pos - lo)
+
+
+class LatencySampler:
+    """Sequential ping test against the max_ping / max_jitter thresholds.
+
+    After every sample the mean is compared with max_ping using a z-score
+    band around it: clearly above means reject, clearly below (with at least
+    `min_accept` samples for a jitter estimate) means accept, and anything
+    near the boundary keeps sampling up to `max_samples`. Jitter is the
+    max-min spread, which can only grow, so crossing max_jitter is final.
+    """
+
+    def __init__(self, max_ping, max_jitter, min_samples=2, min_accept=3, max_samples=8, z=2.0, noise=0.1):
+        self.max_ping = max_ping
+        self.max_jitter = max_jitter
+        self.min_samples = min_samples
+        self.min_accept = min_accept
+        self.max_samples = max_samples
+        self.z = z
+        # Spread is never trusted below this fraction of the mean, so two
+        # lucky identical samples can't make the band collapse to zero
+        self.noise = noise
+        self.samples = []
+
+    def add(self, ms):
+        self.samples.append(ms)
+
+    def mean(self):
+        return sum(self.samples) / len(self.samples)
+
+    def jitter(self):
+        return max(self.samples) - min(self.samples)
+
+    def _band(self):
+        n = len(self.samples)
+        mean = self.mean()
+        var = sum((x - mean) ** 2 for x in self.samples) / (n - 1) if n > 1 else 0.0
+        spread = max(math.sqrt(var), mean * self.noise)
+        return self.z * spread / math.sqrt(n)
+
+    def decision(self):
+        """'ok', 'high_ping' or 'high_jitter' once settled, else None to keep sampling."""
+        n = len(self.samples)
+        if n < self.min_samples:
+            return None
+        mean = self.mean()
+        band = self._band()
+        if mean - band > self.max_ping:
+            return "high_ping"
+        if self.jitter() > self.max_jitter:
+            return "high_jitter"
+        if n >= self.min_accept and mean + band <= self.max_ping:
+            return "ok"
+        if n >= self.max_samples:
+            return self.final()
+        return None
+
+    def final(self):
+        """Forced verdict when sampling has to stop."""
+        if self.mean() > self.max_ping:
+            return "high_ping"
+        if self.jitter() > self.max_jitter:
+            return "high_jitter"
+        return "ok"
+
+    def summary(self):
+        ordered = sorted(self.samples)
+        return {
+            "ping": round(self.mean(), 2),
+            "jitter": round(self.jitter(), 2),
+            "ping_p50": round(percentile(ordered, 50), 2),
+            "ping_p90": round(percentile(ordered, 90), 2),
+            "ping_samples": len(ordered)
+        }
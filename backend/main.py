@@ -1,5 +1,5 @@
 # Copyright (c) 2026 Taher AkbariSaeed
-from fastapi import FastAPI, BackgroundTasks, WebSocket
+from fastapi import FastAPI, BackgroundTasks, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import uvicorn
@@ -12,8 +12,10 @@ import time
 import random
 
 from scanner import scan_ip, parse_vless
-from cf_ips import update_cf_ranges
-from core_manager import download_xray, APP_DIR
+from cf_ips import update_cf_ranges, smart_generator, dead_subnets
+from core_manager import download_xray, wait_for_port, APP_DIR
+from scan_control import create_control, get_control, drop_control
+from scan_events import publish, pump
 import aiohttp
 import socket
 
@@ -36,6 +38,10 @@ class Settings(BaseModel):
     ip_version: str = 'ipv4'
 
 SETTINGS_FILE = os.path.join(APP_DIR, 'settings.json')
+# Snapshot of Smart Discovery's good subnets, so a restart starts warm
+PRIORITY_SUBNETS_FILE = os.path.join(APP_DIR, 'priority_subnets.json')
+# Blocks that were unreachable lately, so a restart doesn't probe them again
+DEAD_SUBNETS_FILE = os.path.join(APP_DIR, 'dead_subnets.json')
 
 def load_settings():
     try:
@@ -71,6 +77,11 @@ class ScanRequest(BaseModel):
     verify_tls: bool = False
     target_country: Optional[str] = None
     use_system_proxy: bool = False
+    xray_engine: bool = True
+    stage_workers: Optional[Dict[str, int]] = None
+    tcp_rate: int = 5000
+    speed_streams: int = 1
+    adaptive_concurrency: bool = True
 
 class FetchConfigRequest(BaseModel):
     url: str
@@ -84,7 +95,11 @@ class ExportRequest(BaseModel):
     ips: List[str]
 
 active_scans = {}
-results = {}
+results = {}  # scan_id -> ScanResultStore
+
+# How long a finished scan stays in memory after its final sync, so the
+# UI's last polls still find it; after that it is served from the queue DB
+FINISHED_SCAN_LINGER = 60
 
 # --- Debug Log System ---
 import sys
@@ -100,10 +115,15 @@ try:
 except Exception:
     pass
 
-from local_queue import load_unfinished_scans, update_scan_status_db, create_scan_task
+from local_queue import load_unfinished_scans, update_scan_status_db, create_scan_task, get_scan_state
+from result_store import ScanResultStore
 
 @app.on_event("startup")
 async def startup_event():
+    loaded = smart_generator.priority_subnets.load(PRIORITY_SUBNETS_FILE)
+    if loaded:
+        print(f"[SmartIP] Restored {loaded} priority subnets")
+    dead_subnets.load(DEAD_SUBNETS_FILE)
     try:
         unfinished = await load_unfinished_scans()
         for row in unfinished:
@@ -117,7 +137,7 @@ async def startup_event():
                 'logs': json.loads(row['logs']) if row['logs'] else [],
                 'stats': json.loads(row['stats']) if row['stats'] else {}
             }
-            results[scan_id] = json.loads(row['results']) if row['results'] else []
+            results[scan_id] = ScanResultStore.from_list(json.loads(row['results']) if row['results'] else [])
             # Note: the actual background scan logic is complex to re-initiate because we need the raw `req` objects. 
             # We restore the state so users can view results and see it as 'paused'. They can restart manually.
     except Exception as e:
@@ -125,11 +145,22 @@ async def startup_event():
 
 async def sync_queue_db(scan_id):
     """Periodically takes the ultra-fast memory dictionary and persists it to SQLite queue"""
+    synced_version = None
+
+    def changed_results():
+        # Results are only re-serialized when something was added since the last sync
+        nonlocal synced_version
+        store = results.get(scan_id)
+        if store is None or store.version == synced_version:
+            return None
+        synced_version = store.version
+        return store.to_list()
+
     while scan_id in active_scans and active_scans[scan_id]['status'] in ['running', 'paused']:
         s = active_scans[scan_id]
         await update_scan_status_db(
             scan_id, s['status'], s.get('total', 0), s.get('completed', 0), 
-            s.get('found_good', 0), s.get('logs', []), s.get('stats', {}), results.get(scan_id, [])
+            s.get('found_good', 0), s.get('logs', []), s.get('stats', {}), changed_results()
         )
         await asyncio.sleep(2)
         
@@ -138,8 +169,19 @@ async def sync_queue_db(scan_id):
         s = active_scans[scan_id]
         await update_scan_status_db(
             scan_id, s['status'], s.get('total', 0), s.get('completed', 0), 
-            s.get('found_good', 0), s.get('logs', []), s.get('stats', {}), results.get(scan_id, [])
+            s.get('found_good', 0), s.get('logs', []), s.get('stats', {}), changed_results()
         )
+        smart_generator.priority_subnets.save(PRIORITY_SUBNETS_FILE)
+        dead_subnets.save(DEAD_SUBNETS_FILE)
+        # Persisted: free it once the UI has had time to pick up the final state
+        await asyncio.sleep(FINISHED_SCAN_LINGER)
+        evict_scan(scan_id)
+
+def evict_scan(scan_id):
+    if get_control(scan_id) is not None:
+        return  # restarted or still tearing down
+    active_scans.pop(scan_id, None)
+    results.pop(scan_id, None)
 
 _debug_logs = deque(maxlen=200)
 
@@ -174,9 +216,9 @@ async def _try_tunnel_with_config(vless_config, db_module):
     try:
         stop_db_tunnel()  # Kill any existing tunnel
         vless_parts = parse_vless(vless_config)
-        start_db_tunnel(vless_parts)
-        await asyncio.sleep(3)
-        success = await db_module.reconnect_db('127.0.0.1', 33060)
+        tunnel_port = start_db_tunnel(vless_parts)
+        await wait_for_port(tunnel_port, timeout=3.0)
+        success = await db_module.reconnect_db('127.0.0.1', tunnel_port)
         if success:
             return True
         stop_db_tunnel()
@@ -224,6 +266,14 @@ async def startup_event():
     asyncio.create_task(run_autopilot_scheduler())
     dlog("=== SERVER READY (DB connecting in background) ===")
 
+@app.on_event('shutdown')
+async def shutdown_event():
+    from core_manager import reaper
+    # Kill and collect any Xray children still alive
+    await reaper.reap_all()
+    smart_generator.priority_subnets.save(PRIORITY_SUBNETS_FILE)
+    dead_subnets.save(DEAD_SUBNETS_FILE)
+
 async def _background_init():
     """Heavy init work that runs AFTER the server is already listening."""
     global _working_vless_config
@@ -593,27 +643,22 @@ async def test_all_db_layers():
                 
         if config_to_test:
             from db_proxy import generate_proxy_config
-            from core_manager import get_xray_path
+            from core_manager import spawn_xray, reaper
             from scanner import parse_vless
-            import tempfile
-            import subprocess
+            
+            from port_pool import reserve_port, release_port
             
             proc = None
+            test_port = None
             try:
                 vless_parts = parse_vless(config_to_test)
-                # Listen on a unique test port to avoid disrupting port 33060 if it's reserved
-                test_port = 33061 
+                # Listen on a separate test port so the live DB tunnel is never disrupted
+                test_port = reserve_port(preferred=33061)
                 xray_config = generate_proxy_config(vless_parts, test_port, db.DB_HOST, db.DB_PORT)
+                proc = await spawn_xray(xray_config, label="db-test-all layer 4")
                 
-                tmp_path = os.path.join(APP_DIR, "test_proxy_config.json")
-                with open(tmp_path, "w") as f:
-                    json.dump(xray_config, f)
-                
-                creationflags = subprocess.CREATE_NO_WINDOW if os.name == 'nt' else 0
-                proc = subprocess.Popen([get_xray_path(), "-c", tmp_path], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, creationflags=creationflags)
-                
-                # Give Xray 1.5 seconds to open the port
-                await asyncio.sleep(1.5)
+                # Wait for Xray to open the port (up to 1.5 seconds)
+                await wait_for_port(test_port, process=proc, timeout=1.5)
                 
                 # Test MySQL through the tunnel
                 async with asyncio.timeout(3.0):
@@ -626,11 +671,8 @@ async def test_all_db_layers():
                 # Tunnel failed to connect to DB
                 results["layer4_tunnel"] = {"status": "offline", "time": round((time.time() - start) * 1000), "reason": "Tunnel connection timed out"}
             finally:
-                if proc:
-                    try:
-                        proc.kill()
-                        proc.wait(timeout=1)
-                    except: pass
+                reaper.reap(proc)
+                release_port(test_port)
         else:
             results["layer4_tunnel"] = {"status": "skipped", "time": 0, "reason": "No VLESS configs available"}
 
@@ -659,10 +701,10 @@ async def proxy_db(req: ProxyDbRequest):
     from scanner import parse_vless
     try:
         vless_parts = parse_vless(req.vless_config)
-        start_db_tunnel(vless_parts)
-        await asyncio.sleep(2)
+        tunnel_port = start_db_tunnel(vless_parts)
+        await wait_for_port(tunnel_port, timeout=2.0)
         
-        success = await db.reconnect_db('127.0.0.1', 33060)
+        success = await db.reconnect_db('127.0.0.1', tunnel_port)
         if success:
             db.db_via_proxy = True
             _working_vless_config = req.vless_config
@@ -843,7 +885,7 @@ async def start_scan(req: ScanRequest, background_tasks: BackgroundTasks):
             'error': 0
         }
     }
-    results[scan_id] = []
+    results[scan_id] = ScanResultStore()
     
     if req.manual_ips and len(req.manual_ips) > 0:
         import ipaddress
@@ -913,11 +955,18 @@ def add_log(scan_id, message):
     if scan_id in active_scans:
         logs = active_scans[scan_id]['logs']
         timestamp = time.strftime('%H:%M:%S')
-        logs.append(f'[{timestamp}] {message}')
+        line = f'[{timestamp}] {message}'
+        logs.append(line)
+        publish(scan_id, 'log', line)
+        # Total ever logged: the cursor for incremental polls, since logs is trimmed
+        active_scans[scan_id]['log_count'] = active_scans[scan_id].get('log_count', len(logs) - 1) + 1
         if len(logs) > 100:
             active_scans[scan_id]['logs'] = logs[-100:]
 
 async def run_scan_job(scan_id, ips_static, vless_parts, req, user_info):
+    engine = None
+    control = create_control(scan_id, active_scans[scan_id])
+    started = time.monotonic()
     try:
         thresholds = {
             'max_ping': req.max_ping, 
@@ -926,7 +975,7 @@ async def run_scan_job(scan_id, ips_static, vless_parts, req, user_info):
             'min_upload': req.min_upload
         }
         
-        from cf_ips import get_smart_ip, report_good_ip, SmartIPGenerator, fetch_custom_ips
+        from cf_ips import smart_generator, SmartIPGenerator, fetch_custom_ips
         from db import save_scan_result
         
         custom_generator = None
@@ -992,11 +1041,10 @@ async def run_scan_job(scan_id, ips_static, vless_parts, req, user_info):
             else:
                 add_log(scan_id, 'No Gold IPs found, falling back to Smart Discovery...')
                 
-        discovery_sem = asyncio.Semaphore(req.concurrency * 5)
-        speed_sem = asyncio.Semaphore(req.concurrency) 
-        
         good_ips_count = 0
         scanned_count = 0
+        # A walk of its own, so this scan never probes the same IP twice
+        generator = custom_generator or smart_generator.fork()
         
         if ips_static and req.test_ports:
             new_static = [(ip, pt) for ip in ips_static for pt in req.test_ports]
@@ -1012,7 +1060,6 @@ async def run_scan_job(scan_id, ips_static, vless_parts, req, user_info):
             # Pre-seed the scanner with historically successful subnets from DB
             try:
                 from db import get_smart_recommendations
-                from cf_ips import smart_generator
                 loc_str = user_info.get('location', 'Unknown')
                 country = loc_str.split('-')[0].strip() if '-' in loc_str else ''
                 recs = await get_smart_recommendations(
@@ -1029,155 +1076,214 @@ async def run_scan_job(scan_id, ips_static, vless_parts, req, user_info):
         
         add_log(scan_id, f'Started scan. Goal: Find {req.stop_after} Good IPs. Threads: {req.concurrency}. Mode: {mode_name}')
         
-        running_tasks = set()
+        from scanner import new_result, open_tunnel, probe_tls, probe_latency, probe_colo, probe_throughput
+        from scan_pipeline import Candidate, Stage, ScanPipeline
+        from tcp_sweep import TcpSweeper
+        from aimd import AimdController
+        
+        # Per-stage worker budgets: cheap checks run wide, tunnel-holding stages
+        # are bounded by Xray cores and throughput by bandwidth.
+        workers = {
+            'tcp': max(req.concurrency * 20, 1024),
+            'tls': max(req.concurrency * 20, 1024),
+            'latency': req.concurrency * 5,
+            'colo': req.concurrency * 2,
+            'throughput': req.concurrency
+        }
+        workers.update({k: v for k, v in (req.stage_workers or {}).items() if k in workers and v > 0})
+        
+        # Pre-filter connects are paced to tcp_rate and capped by the fd limit
+        sweeper = TcpSweeper(rate=max(req.tcp_rate, 1), timeout=1.0, max_inflight=workers['tcp'])
+        workers['tcp'] = sweeper.max_inflight
+        workers['tls'] = min(workers['tls'], sweeper.max_inflight)
+        
+        # AIMD: the tunnel and throughput stages start at half their budget so
+        # the baselines are taken uncongested, then probe up to twice it and
+        # back off when timeouts or latency spike
+        controllers = {}
+        if req.adaptive_concurrency:
+            for name in ('latency', 'throughput'):
+                controllers[name] = AimdController(name, start=max(1, workers[name] // 2), min_limit=1, max_limit=workers[name] * 2)
+                workers[name] *= 2
+        
+        if getattr(req, 'xray_engine', True):
+            # One shared multi-target Xray core instead of a process per candidate,
+            # sized for every candidate that can hold a tunnel at once
+            from xray_engine import XrayEngine
+            engine = XrayEngine(vless_parts, batch_size=workers['latency'] + 2 * (workers['colo'] + workers['throughput']))
+        
+        provider_val = "fastly" if getattr(req, 'ip_source', '') == 'fastly_cdn' else "cloudflare"
+        # 1 = classic single-stream speed test, more = parallel streams per tunnel
+        speed_streams = min(max(req.speed_streams, 1), 8)
+        
+        async def tcp_stage(cand):
+            # Fast TCP Pre-Filter
+            target_port = cand.port if cand.port else vless_parts.get('port', 443)
+            rtt = await sweeper.probe(cand.ip, target_port)
+            if rtt >= 0:
+                cand.result['tcp_rtt'] = rtt
+                return True
+            cand.result.update({'ping': -1, 'jitter': 0, 'download': 0, 'upload': 0, 'status': 'unreachable', 'asn': 'Unknown'})
+            return False
+        
+        async def tls_stage(cand):
+            return await probe_tls(cand.ip, vless_parts, cand.result, test_port=cand.port)
+        
+        async def latency_stage(cand):
+            port_str = f":{cand.port}" if cand.port else ""
+            add_log(scan_id, f'Checking {cand.ip}{port_str}...')
+            cand.tunnel = await open_tunnel(cand.ip, vless_parts, cand.result, test_port=cand.port, engine=engine, streams=speed_streams)
+            if cand.tunnel is None:
+                return False
+            return await probe_latency(cand.tunnel.session, cand.result, thresholds, control)
+        
+        async def colo_stage(cand):
+            return await probe_colo(cand.tunnel.session, cand.result, provider_val)
         
-        async def bounded_scan(ip, t_port=None):
+        async def throughput_stage(cand):
+            return await probe_throughput(cand.tunnel.session, cand.ip, vless_parts, cand.result, thresholds, control, streams=speed_streams)
+        
+        async def record_result(cand):
             nonlocal good_ips_count
+            ip, t_port, res = cand.ip, cand.port, cand.result
             
-            while active_scans[scan_id]['status'] == 'paused':
-                await asyncio.sleep(0.5)
-                
-            if active_scans[scan_id]['status'] != 'running': return
+            if not await control.wait_running(): return
             
-            async with discovery_sem:
-                port_str = f":{t_port}" if t_port else ""
-                
-                # Fast TCP Pre-Filter
-                from scanner import tcp_ping
-                target_port = t_port if t_port else vless_parts.get('port', 443)
-                is_reachable = await tcp_ping(ip, target_port, timeout=1.0)
+            if 'stats' in active_scans[scan_id]:
+                stats = active_scans[scan_id]['stats']
+                stats['scanned'] += 1
                 
-                if not is_reachable:
-                    res = {
-                        'ping': -1, 'jitter': 0, 'download': 0, 'upload': 0,
-                        'status': 'unreachable', 'datacenter': 'Unknown', 'asn': 'Unknown'
-                    }
+                status_key = res['status']
+                if status_key == 'ok':
+                    pass 
+                elif status_key == 'high_ping':
+                    stats['high_ping'] += 1
+                elif status_key == 'high_jitter':
+                    stats['high_jitter'] += 1
+                elif status_key == 'low_download':
+                    stats['low_download'] += 1
+                elif status_key == 'low_upload':
+                    stats['low_upload'] += 1
+                elif status_key in ('unreachable', 'tunnel_unreachable'):
+                    stats['unreachable'] += 1
+                elif status_key == 'timeout':
+                    stats['timeout'] += 1
+                elif status_key == 'compromised':
+                    stats['compromised'] += 1
                 else:
-                    add_log(scan_id, f'Checking {ip}{port_str}...')
-                    provider_val = "fastly" if getattr(req, 'ip_source', '') == 'fastly_cdn' else "cloudflare"
-                    res = await scan_ip(ip, vless_parts, thresholds, speed_sem, test_port=t_port, verify_tls=req.verify_tls, check_status_cb=lambda: active_scans[scan_id]['status'], provider=provider_val)
-                
-                    if res['status'] == 'abort':
-                        return
-                
-                while active_scans[scan_id]['status'] == 'paused':
-                    await asyncio.sleep(0.5)
-                
-                if active_scans[scan_id]['status'] != 'running': return
-                
-                if 'stats' in active_scans[scan_id]:
-                    stats = active_scans[scan_id]['stats']
-                    stats['scanned'] += 1
-                    
-                    status_key = res['status']
-                    if status_key == 'ok':
-                        pass 
-                    elif status_key == 'high_ping':
-                        stats['high_ping'] += 1
-                    elif status_key == 'high_jitter':
-                        stats['high_jitter'] += 1
-                    elif status_key == 'low_download':
-                        stats['low_download'] += 1
-                    elif status_key == 'low_upload':
-                        stats['low_upload'] += 1
-                    elif status_key == 'unreachable':
-                        stats['unreachable'] += 1
-                    elif status_key == 'timeout':
-                        stats['timeout'] += 1
-                    elif status_key == 'compromised':
-                        stats['compromised'] += 1
-                    else:
-                        stats['error'] += 1
+                    stats['error'] += 1
 
-                is_good = res['status'] == 'ok'
+            is_good = res['status'] == 'ok'
+            
+            if is_good:
+                enriched = await enrich_ip_data(ip, getattr(req, 'use_system_proxy', False))
                 
-                if is_good:
-                    enriched = await enrich_ip_data(ip, getattr(req, 'use_system_proxy', False))
-                    
-                    if req.target_country and enriched['countryCode'].upper() != req.target_country.upper():
-                        is_good = False
-                        res['status'] = 'wrong_geo'
-                        add_log(scan_id, f"Rejected {ip}: Wrong Geo ({enriched['countryCode']})")
-                    else:
-                        add_log(scan_id, f"GOOD IP FOUND: {ip} (Ping: {res['ping']}ms, DL: {res['download']}Mbps)")
-                        if custom_generator:
-                            custom_generator.report_success(ip)
-                        else:
-                            report_good_ip(ip)
-                            
-                        # Save to working configs history
-                        try:
-                            protocol = vless_parts.get("protocol", "vless")
-                            params = vless_parts.get('params', {}).copy()
-                            param_str = "&".join([f"{k}={v}" for k, v in params.items()])
-                            port = t_port if t_port else vless_parts.get('port', 443)
-                            
-                            # Determine the Sni to put in the VLESS string
-                            sni_val = test_sni if 'test_sni' in locals() and test_sni else params.get('sni', '')
-                            if sni_val:
-                                params['sni'] = sni_val
-                            param_str = "&".join([f"{k}={v}" for k, v in params.items()])
-                            
-                            working_link = f"{protocol}://{vless_parts.get('uuid', 'none')}@{ip}:{port}?{param_str}#{ip}"
-                            
-                            history_file = os.path.join(APP_DIR, 'latest_working_configs.json')
-                            history = []
-                            if os.path.exists(history_file):
-                                with open(history_file, 'r') as f:
-                                    history = json.load(f)
-                            if working_link not in history:
-                                history.insert(0, working_link)
-                                history = history[:20]  # Keep latest 20
-                                with open(history_file, 'w') as f:
-                                    json.dump(history, f)
-                        except Exception as e:
-                            add_log(scan_id, f"Error saving working config: {e}")
-                        
-                        res['location'] = enriched['location']
-                        res['asn'] = enriched['asn']
-                        good_ips_count += 1
-                        active_scans[scan_id]['found_good'] = good_ips_count
+                if req.target_country and enriched['countryCode'].upper() != req.target_country.upper():
+                    is_good = False
+                    res['status'] = 'wrong_geo'
+                    add_log(scan_id, f"Rejected {ip}: Wrong Geo ({enriched['countryCode']})")
                 else:
-                    add_log(scan_id, f"Failed {ip}: {res['status']}")
-                
-                asyncio.create_task(save_scan_result({
-                    'user_ip': user_info.get('ip'),
-                    'user_location': user_info.get('location'),
-                    'user_isp': user_info.get('isp'),
-                    'vless_uuid': vless_parts.get('uuid'),
-                    'scanned_ip': ip,
-                    'ip_source': getattr(req, 'ip_source', 'official') if not ips_static else (getattr(req, 'ip_source', 'manual')),
-                    'ping': res['ping'],
-                    'jitter': res['jitter'],
-                    'download': res['download'],
-                    'upload': res['upload'],
-                    'status': res['status'],
-                    'datacenter': res.get('datacenter', 'Unknown'),
-                    'asn': res.get('asn', 'Unknown'),
-                    'network_type': vless_parts.get('params', {}).get('type', 'Unknown'),
-                    'sni': vless_parts.get('params', {}).get('sni', 'Unknown'),
-                    'port': t_port if t_port else vless_parts.get('port', -1),
-                    'app_version': '1.0.0',
-                    'provider': "fastly" if getattr(req, 'ip_source', '') == 'fastly_cdn' else "cloudflare"
-                }))
-
-                results[scan_id].append(res)
-                active_scans[scan_id]['completed'] += 1
-                
-                if good_ips_count >= req.stop_after:
-                    add_log(scan_id, 'Limit reached. Stopping scan.')
-                    active_scans[scan_id]['status'] = 'completed'
-
-        while active_scans[scan_id]['status'] in ['running', 'paused']:
-            if good_ips_count >= req.stop_after: break
-            if scanned_count >= target_count: break
+                    add_log(scan_id, f"GOOD IP FOUND: {ip} (Ping: {res['ping']}ms, DL: {res['download']}Mbps)")
+                        
+                    # Save to working configs history
+                    try:
+                        protocol = vless_parts.get("protocol", "vless")
+                        params = vless_parts.get('params', {}).copy()
+                        param_str = "&".join([f"{k}={v}" for k, v in params.items()])
+                        port = t_port if t_port else vless_parts.get('port', 443)
+                        
+                        # Determine the Sni to put in the VLESS string
+                        sni_val = test_sni if 'test_sni' in locals() and test_sni else params.get('sni', '')
+                        if sni_val:
+                            params['sni'] = sni_val
+                        param_str = "&".join([f"{k}={v}" for k, v in params.items()])
+                        
+                        working_link = f"{protocol}://{vless_parts.get('uuid', 'none')}@{ip}:{port}?{param_str}#{ip}"
+                        
+                        history_file = os.path.join(APP_DIR, 'latest_working_configs.json')
+                        history = []
+                        if os.path.exists(history_file):
+                            with open(history_file, 'r') as f:
+                                history = json.load(f)
+                        if working_link not in history:
+                            history.insert(0, working_link)
+                            history = history[:20]  # Keep latest 20
+                            with open(history_file, 'w') as f:
+                                json.dump(history, f)
+                    except Exception as e:
+                        add_log(scan_id, f"Error saving working config: {e}")
+                    
+                    res['location'] = enriched['location']
+                    res['asn'] = enriched['asn']
+                    good_ips_count += 1
+                    active_scans[scan_id]['found_good'] = good_ips_count
+            else:
+                add_log(scan_id, f"Failed {ip}: {res['status']}")
             
-            if active_scans[scan_id]['status'] == 'paused':
-                await asyncio.sleep(0.5)
-                continue
+            asyncio.create_task(save_scan_result({
+                'user_ip': user_info.get('ip'),
+                'user_location': user_info.get('location'),
+                'user_isp': user_info.get('isp'),
+                'vless_uuid': vless_parts.get('uuid'),
+                'scanned_ip': ip,
+                'ip_source': getattr(req, 'ip_source', 'official') if not ips_static else (getattr(req, 'ip_source', 'manual')),
+                'ping': res['ping'],
+                'jitter': res['jitter'],
+                'download': res['download'],
+                'upload': res['upload'],
+                'status': res['status'],
+                'datacenter': res.get('datacenter', 'Unknown'),
+                'asn': res.get('asn', 'Unknown'),
+                'network_type': vless_parts.get('params', {}).get('type', 'Unknown'),
+                'sni': vless_parts.get('params', {}).get('sni', 'Unknown'),
+                'port': t_port if t_port else vless_parts.get('port', -1),
+                'app_version': '1.0.0',
+                'provider': "fastly" if getattr(req, 'ip_source', '') == 'fastly_cdn' else "cloudflare"
+            }))
+
+            # Failures too: the generator learns which neighborhoods are dead
+            generator.report_result(ip, is_good, res['status'], t_port or 0)
+            results[scan_id].append(res)
+            active_scans[scan_id]['completed'] += 1
+            if is_good:
+                publish(scan_id, 'result', res)
+            publish(scan_id, 'stats')
             
-            while len(running_tasks) < req.concurrency * 5 and scanned_count < target_count:
-                if active_scans[scan_id]['status'] != 'running': break
+            if good_ips_count >= req.stop_after:
+                # The scan's wall time ends here, not when teardown does
+                active_scans[scan_id]['duration'] = round(time.monotonic() - started, 2)
+                add_log(scan_id, 'Limit reached. Stopping scan.')
+                # Cancels the probes still in flight; close() below tears down their tunnels
+                control.stop('completed')
+
+        last_backoff_log = {}
+        
+        def on_decision(stage_name, decision):
+            active_scans[scan_id]['stats'].setdefault('aimd', {})[stage_name] = controllers[stage_name].stats()
+            # Back-offs come in bursts under throttling; one log line per stage every 10 s
+            if decision['action'] == 'decrease' and time.time() - last_backoff_log.get(stage_name, 0) > 10:
+                last_backoff_log[stage_name] = time.time()
+                add_log(scan_id, f"Backing off {stage_name}: {decision['from']} -> {decision['to']} ({decision['reason']})")
+        
+        pipeline = ScanPipeline([
+            Stage('tcp', tcp_stage, workers['tcp']),
+            Stage('tls', tls_stage, workers['tls']) if req.verify_tls else None,
+            Stage('latency', latency_stage, workers['latency'], controller=controllers.get('latency'),
+                  signal=lambda cand: cand.result['ping'] if cand.result['ping'] > 0 else None),
+            # Candidates waiting here hold a tunnel, so keep the queues short
+            Stage('colo', colo_stage, workers['colo'], queue_size=workers['colo']),
+            Stage('throughput', throughput_stage, workers['throughput'], queue_size=workers['throughput'],
+                  controller=controllers.get('throughput'), signal=lambda cand: cand.result.get('ttfb', -1))
+        ], record_result, control=control, on_decision=on_decision)
+        if controllers:
+            active_scans[scan_id]['stats']['aimd'] = {name: c.stats() for name, c in controllers.items()}
+        active_scans[scan_id]['pipeline'] = pipeline.stats()
+        pipeline.start()
+        
+        try:
+            while scanned_count < target_count and good_ips_count < req.stop_after:
+                # Blocks on the control's event while paused
+                if not await control.wait_running(): break
                 
                 if ips_static:
                     item = ips_static[scanned_count]
@@ -1186,31 +1292,37 @@ async def run_scan_job(scan_id, ips_static, vless_parts, req, user_info):
                     else:
                         ip, t_port = item, None
                 else:
-                    if custom_generator:
-                        ip = custom_generator.get_next_ip(req.ip_version)
-                    else:
-                        ip = get_smart_ip(req.ip_version)
                     t_port = req.test_ports[scanned_count % len(req.test_ports)] if req.test_ports else None
-                    
-                task = asyncio.create_task(bounded_scan(ip, t_port))
-                running_tasks.add(task)
-                task.add_done_callback(running_tasks.discard)
-                scanned_count += 1
-                
-            if not running_tasks:
-                break
+                    ip = generator.get_next_ip(req.ip_version, t_port or 0)
+                    if ip is None:
+                        add_log(scan_id, 'Every IP in the selected ranges has been tried.')
+                        break
                 
-            await asyncio.sleep(0.1)
+                ip = ip.strip()
+                scanned_count += 1
+                if not ip: continue
+                # Waits while the TCP stage's queue is full
+                if not await pipeline.put(Candidate(ip, t_port, new_result(ip))): break
+                if scanned_count % 100 == 0:
+                    active_scans[scan_id]['pipeline'] = pipeline.stats()
+                    active_scans[scan_id]['sweep'] = sweeper.rate_stats()
+                    active_scans[scan_id]['bandit'] = dict(generator.bandit.stats(), skipped_dead=generator.skipped_dead)
+                    publish(scan_id, 'stats')
             
-        if running_tasks:
-            await asyncio.gather(*running_tasks)
+            await pipeline.join()
+        finally:
+            await pipeline.close(timeout=5.0)
+            active_scans[scan_id]['pipeline'] = pipeline.stats()
+            active_scans[scan_id]['sweep'] = sweeper.rate_stats()
         
-        active_scans[scan_id]['status'] = 'completed'
-        add_log(scan_id, 'Scan finished.')
+        # A user stop keeps its 'stopped' status
+        control.stop('completed', cancel=False)
+        active_scans[scan_id].setdefault('duration', round(time.monotonic() - started, 2))
+        add_log(scan_id, f"Scan finished in {active_scans[scan_id]['duration']}s.")
         
         try:
             os.makedirs('results', exist_ok=True)
-            good_results = [r for r in results[scan_id] if r['status'] == 'ok']
+            good_results = results[scan_id].good_results()
             if good_results:
                 with open(f"results/scan_{scan_id}.json", 'w') as f:
                     json.dump(good_results, f, indent=2)
@@ -1223,41 +1335,108 @@ async def run_scan_job(scan_id, ips_static, vless_parts, req, user_info):
         print(err_msg)
         add_log(scan_id, f"CRITICAL ERROR: {str(e)}")
         active_scans[scan_id]['status'] = 'failed'
+        publish(scan_id, 'status', 'failed')
+    finally:
+        drop_control(scan_id)
+        publish(scan_id, 'end')
+        if engine:
+            await engine.close()
 
 @app.get('/scan/{scan_id}')
-def get_scan_status(scan_id: str):
+async def get_scan_status(scan_id: str, since: Optional[int] = None, logs_since: Optional[int] = None):
+    """Full state, or with `since`/`logs_since` only what arrived after those cursors.
+
+    Incremental replies carry `cursor` for the next poll; good results come
+    in arrival order and logs hold just the new lines.
+    """
     if scan_id not in active_scans:
-        return {'error': 'Scan not found'}
+        # Finished scans are evicted from memory; fall back to their persisted state
+        row = await get_scan_state(scan_id)
+        if not row:
+            return {'error': 'Scan not found'}
+        stored = json.loads(row['results']) if row['results'] else []
+        return {
+            'status': {
+                'status': row['status'],
+                'total': row['total'],
+                'completed': row['completed'],
+                'found_good': row['found_good'],
+                'logs': json.loads(row['logs']) if row['logs'] else [],
+                'stats': json.loads(row['stats']) if row['stats'] else {}
+            },
+            'results': sorted([r for r in stored if r.get('status') == 'ok'], key=lambda x: x.get('ping', 9999))
+        }
     
-    all_results = results[scan_id]
-    valid_results = [r for r in all_results if r.get('status') == 'ok']
+    state = active_scans[scan_id]
+    store = results[scan_id]
+    if since is None and logs_since is None:
+        return {
+            'status': state,
+            'results': store.ranked_results(),
+            'cursor': {'since': len(store.good), 'logs_since': state.get('log_count', len(state['logs']))}
+        }
     
+    new_results, next_since = store.good_since(since or 0)
+    logs = state['logs']
+    log_count = state.get('log_count', len(logs))
+    unseen = log_count - (logs_since or 0)
+    status = {k: v for k, v in state.items() if k != 'logs'}
+    status['logs'] = logs[-unseen:] if unseen > 0 else []
     return {
-        'status': active_scans[scan_id],
-        'results': sorted(valid_results, key=lambda x: x.get('ping', 9999))
+        'status': status,
+        'results': new_results,
+        'incremental': True,
+        'cursor': {'since': next_since, 'logs_since': log_count}
     }
 
 @app.post('/scan/{scan_id}/pause')
-def pause_scan(scan_id: str):
-    if scan_id in active_scans and active_scans[scan_id]['status'] == 'running':
+async def pause_scan(scan_id: str):
+    control = get_control(scan_id)
+    if control:
+        if control.pause():
+            return {'status': 'ok'}
+    elif scan_id in active_scans and active_scans[scan_id]['status'] == 'running':
         active_scans[scan_id]['status'] = 'paused'
+        publish(scan_id, 'status', 'paused')
         return {'status': 'ok'}
     return {'error': 'Cannot pause'}
 
 @app.post('/scan/{scan_id}/resume')
-def resume_scan(scan_id: str):
-    if scan_id in active_scans and active_scans[scan_id]['status'] == 'paused':
+async def resume_scan(scan_id: str):
+    control = get_control(scan_id)
+    if control:
+        if control.resume():
+            return {'status': 'ok'}
+    elif scan_id in active_scans and active_scans[scan_id]['status'] == 'paused':
         active_scans[scan_id]['status'] = 'running'
+        publish(scan_id, 'status', 'running')
         return {'status': 'ok'}
     return {'error': 'Cannot resume'}
 
 @app.post('/scan/{scan_id}/stop')
-def stop_scan(scan_id: str):
+async def stop_scan(scan_id: str):
+    control = get_control(scan_id)
+    if control:
+        # Cancels in-flight probes; their tunnels and cores are torn down on the way out
+        control.stop('stopped')
+        return {'status': 'ok'}
     if scan_id in active_scans:
         active_scans[scan_id]['status'] = 'stopped'
+        publish(scan_id, 'status', 'stopped')
         return {'status': 'ok'}
     return {'error': 'Cannot stop'}
 
+@app.websocket('/scan/{scan_id}/events')
+async def scan_events_ws(websocket: WebSocket, scan_id: str):
+    """Live log/result/stats/status events for a normal or advanced scan (see scan_events.pump)."""
+    await websocket.accept()
+    try:
+        await pump(scan_id, websocket.send_json, lambda: active_scans.get(scan_id),
+                   lambda: get_control(scan_id) is not None)
+        await websocket.close()
+    except (WebSocketDisconnect, RuntimeError):
+        pass  # client went away
+
 class UsageLogRequest(BaseModel):
     event_type: str
     details: str = ''
@@ -1358,7 +1537,7 @@ def start_advanced_scan(req: ScanAdvancedRequest, background_tasks: BackgroundTa
             'unreachable': 0, 'error': 0
         }
     }
-    results[scan_id] = []
+    results[scan_id] = ScanResultStore()
     
     # Persistent SQLite Registration
     background_tasks.add_task(create_advanced_scan_wrapper, scan_id, req.target_ip, vless_parts, req, items_to_test)
@@ -1412,6 +1591,7 @@ async def run_advanced_scan_job(scan_id, target_ip, vless_parts, req, items_to_t
                 test_port=None, 
                 fragment=item.get('fragment'), 
                 test_sni=item.get('test_sni'),
+                control=control,
                 advanced_dns_config=dns_payload
             )
         
@@ -1445,24 +1625,37 @@ async def run_advanced_scan_job(scan_id, target_ip, vless_parts, req, items_to_t
         res['tested_config'] = item['id']
         results[scan_id].append(res)
         active_scans[scan_id]['completed'] += 1
+        if res['status'] == 'ok':
+            publish(scan_id, 'result', res)
+        publish(scan_id, 'stats')
 
+    control = create_control(scan_id, active_scans[scan_id])
     try:
-        while active_scans[scan_id]['status'] == 'running' and scanned_count < total_items:
+        while scanned_count < total_items:
+            if not await control.wait_running():
+                break
             while len(running_tasks) < req.concurrency and scanned_count < total_items:
-                task = asyncio.create_task(bounded_advanced_scan(scanned_count))
+                task = control.track(asyncio.create_task(bounded_advanced_scan(scanned_count)))
                 running_tasks.add(task)
                 task.add_done_callback(running_tasks.discard)
                 scanned_count += 1
-            await asyncio.sleep(0.1)
+            # Wake when a slot frees up rather than polling for one
+            if running_tasks:
+                await asyncio.wait(set(running_tasks), return_when=asyncio.FIRST_COMPLETED)
             
         if running_tasks:
-            await asyncio.gather(*running_tasks)
+            await asyncio.gather(*running_tasks, return_exceptions=True)
             
-        active_scans[scan_id]['status'] = 'completed'
-        add_log(scan_id, 'Advanced Scan finished.')
+        if not control.is_stopped():
+            control.stop('completed', cancel=False)
+            add_log(scan_id, 'Advanced Scan finished.')
     except Exception as e:
         add_log(scan_id, f"CRITICAL ERROR: {str(e)}")
         active_scans[scan_id]['status'] = 'failed'
+        publish(scan_id, 'status', 'failed')
+    finally:
+        drop_control(scan_id)
+        publish(scan_id, 'end')
 
 from pydantic import BaseModel
 class LogBypassRequest(BaseModel):
@@ -1534,16 +1727,30 @@ def get_warp_scan_status(scan_id: str):
     }
 
 @app.post('/scan-warp/{scan_id}/stop')
-def stop_warp_scan(scan_id: str):
-    if scan_id in active_warp_scans: active_warp_scans[scan_id]['status'] = 'stopped'
+async def stop_warp_scan(scan_id: str):
+    if scan_id in active_warp_scans:
+        active_warp_scans[scan_id]['status'] = 'stopped'
+        publish(scan_id, 'status', 'stopped')
     return {'status': 'stopped'}
 
+@app.websocket('/scan-warp/{scan_id}/events')
+async def warp_scan_events(websocket: WebSocket, scan_id: str):
+    await websocket.accept()
+    try:
+        await pump(scan_id, websocket.send_json, lambda: active_warp_scans.get(scan_id),
+                   lambda: active_warp_scans.get(scan_id, {}).get('status') == 'running')
+        await websocket.close()
+    except (WebSocketDisconnect, RuntimeError):
+        pass
+
 async def run_warp_job(scan_id, req):
     from warp_scanner import scan_warp_ip
     from cf_ips import get_smart_ip
     
     sem = asyncio.Semaphore(req.concurrency)
-    def wlog(msg): active_warp_scans[scan_id]['logs'].append(msg)
+    def wlog(msg):
+        active_warp_scans[scan_id]['logs'].append(msg)
+        publish(scan_id, 'log', msg)
     
     wlog("Starting WARP Endpoint Scanner...")
     
@@ -1555,10 +1762,13 @@ async def run_warp_job(scan_id, req):
             if res['status'] == 'ok' and res['ping'] <= req.max_ping:
                 active_warp_scans[scan_id]['found_good'] += 1
                 warp_results[scan_id].append(res)
+                publish(scan_id, 'result', res)
                 wlog(f"Found clean WARP endpoint: {res['endpoint']} ({res['ping']}ms, {res['datacenter']})")
                 
                 if active_warp_scans[scan_id]['found_good'] >= req.stop_after:
                     active_warp_scans[scan_id]['status'] = 'completed'
+                    publish(scan_id, 'status', 'completed')
+            publish(scan_id, 'stats')
                     
     tasks = []
     # Test up to 5000 random IPs
@@ -1576,7 +1786,9 @@ async def run_warp_job(scan_id, req):
     if tasks: await asyncio.gather(*tasks)
     if active_warp_scans[scan_id]['status'] == 'running':
         active_warp_scans[scan_id]['status'] = 'completed'
+        publish(scan_id, 'status', 'completed')
     wlog("WARP Scan job finished.")
+    publish(scan_id, 'end')
 
 if __name__ == '__main__':
     uvicorn.run(app, host='127.0.0.1', port=8000)
@@ -0,0 +1,105 @@
+# Copyright (c) 2026 Taher AkbariSaeed
+import random
+import socket
+import time
+
+
+class PortPool:
+    """Hands out loopback ports for Xray inbounds without collisions.
+
+    A port is only handed out after a test bind succeeds and stays reserved
+    until it is released. Released ports sit in quarantine for a while so a
+    socket lingering in TIME_WAIT can't make the next core fail to boot, and
+    ports found busy are quarantined longer so they aren't retried at once.
+    """
+
+    def __init__(self, start=10000, end=20000, quarantine=15.0, busy_quarantine=60.0):
+        self.start = start
+        self.end = end
+        self.quarantine = quarantine
+        self.busy_quarantine = busy_quarantine
+        self._reserved = set()
+        self._quarantined = {}  # port -> monotonic time it becomes usable again
+
+    def _can_bind(self, port):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            s.bind(("127.0.0.1", port))
+            return True
+        except OSError:
+            return False
+        finally:
+            s.close()
+
+    def _is_free(self, port, now):
+        if port in self._reserved:
+            return False
+        until = self._quarantined.get(port)
+        if until is not None:
+            if until > now:
+                return False
+            del self._quarantined[port]
+        return True
+
+    def _try_take(self, port, now):
+        if not self._is_free(port, now):
+            return False
+        if not self._can_bind(port):
+            self._quarantined[port] = now + self.busy_quarantine
+            return False
+        self._reserved.add(port)
+        return True
+
+    def reserve(self, preferred=None):
+        """Reserve one verified-free port, trying `preferred` first if given."""
+        now = time.monotonic()
+        if preferred is not None and self._try_take(preferred, now):
+            return preferred
+        for _ in range(256):
+            port = random.randint(self.start, self.end)
+            if self._try_take(port, now):
+                return port
+        # Random probing keeps failing: fall back to a full sweep of the range
+        for port in range(self.start, self.end + 1):
+            if self._try_take(port, now):
+                return port
+        raise RuntimeError(f"No free local ports in {self.start}-{self.end}")
+
+    def reserve_many(self, count):
+        ports = []
+        try:
+            for _ in range(count):
+                ports.append(self.reserve())
+        except RuntimeError:
+            self.release_many(ports)
+            raise
+        return ports
+
+    def release(self, port, quarantine=None):
+        if port is None or port not in self._reserved:
+            return
+        self._reserved.discard(port)
+        hold = self.quarantine if quarantine is None else quarantine
+        if hold > 0:
+            self._quarantined[port] = time.monotonic() + hold
+
+    def release_many(self, ports, quarantine=None):
+        for port in ports:
+            self.release(port, quarantine)
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            "reserved": len(self._reserved),
+            "quarantined": sum(1 for until in self._quarantined.values() if until > now)
+        }
+
+
+# Shared pool for scan inbounds, engine cores and DB tunnels
+port_pool = PortPool()
+
+def reserve_port(preferred=None):
+    return port_pool.reserve(preferred)
+
+def release_port(port, quarantine=None):
+    port_pool.release(port, quarantine)
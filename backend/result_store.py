@@ -0,0 +1,100 @@
+# Copyright (c) 2026 Taher AkbariSaeed
+from bisect import bisect
+from collections import Counter, deque
+
+# Keys a probe result can carry; anything else lands in ScanRecord.extra
+_FIELDS = (
+    "ip", "status", "ping", "jitter", "download", "upload", "datacenter",
+    "location", "asn", "link", "tcp_rtt", "tls_rtt", "ttfb",
+    "ping_p50", "ping_p90", "ping_samples", "tested_config", "fail_reason"
+)
+_FIELD_SET = frozenset(_FIELDS)
+
+
+class ScanRecord:
+    """One probed IP, held in slots instead of a per-result dict."""
+
+    __slots__ = _FIELDS + ("extra",)
+
+    def __init__(self, result):
+        for name in _FIELDS:
+            setattr(self, name, result.get(name))
+        extra = {k: v for k, v in result.items() if k not in _FIELD_SET}
+        self.extra = extra or None
+
+    def get(self, key, default=None):
+        if key in _FIELD_SET:
+            value = getattr(self, key)
+            return default if value is None else value
+        return self.extra.get(key, default) if self.extra else default
+
+    def to_dict(self):
+        data = {}
+        for name in _FIELDS:
+            value = getattr(self, name)
+            if value is not None:
+                data[name] = value
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+
+class ScanResultStore:
+    """Results of one scan with memory bounded by what is worth showing.
+
+    Good IPs are all kept as ScanRecords, both in arrival order (their
+    index is the cursor for incremental polls) and in a ping-sorted list
+    maintained by insertion, so no poll has to sort. Failures, which are
+    most of a large scan, only bump a per-status counter and keep the
+    latest `failure_sample` of them for inspection. `version` changes on
+    every append so persistence can skip unchanged stores.
+    """
+
+    def __init__(self, failure_sample=50):
+        self.good = []
+        self._ranked = []
+        self._ranked_keys = []
+        self.failures = Counter()
+        self.failure_sample = deque(maxlen=failure_sample)
+        self.version = 0
+
+    def append(self, result):
+        record = ScanRecord(result)
+        if record.status == 'ok':
+            self.good.append(record)
+            # Ties keep arrival order
+            key = (record.ping if record.ping is not None else 9999, len(self.good))
+            pos = bisect(self._ranked_keys, key)
+            self._ranked_keys.insert(pos, key)
+            self._ranked.insert(pos, record)
+        else:
+            self.failures[record.status or 'unknown'] += 1
+            self.failure_sample.append(record)
+        self.version += 1
+
+    def __len__(self):
+        return len(self.good) + sum(self.failures.values())
+
+    def good_results(self):
+        return [record.to_dict() for record in self.good]
+
+    def ranked_results(self, limit=None):
+        """Good results by ascending ping, the best `limit` if given."""
+        ranked = self._ranked if limit is None else self._ranked[:limit]
+        return [record.to_dict() for record in ranked]
+
+    def good_since(self, cursor):
+        """Good results that arrived after the first `cursor`, and the next cursor."""
+        cursor = max(0, min(cursor, len(self.good)))
+        return [record.to_dict() for record in self.good[cursor:]], len(self.good)
+
+    def to_list(self):
+        """Plain dicts for persisting: every good IP plus the failure sample."""
+        return self.good_results() + [record.to_dict() for record in self.failure_sample]
+
+    @classmethod
+    def from_list(cls, items):
+        store = cls()
+        for item in items or []:
+            store.append(item)
+        return store
@@ -0,0 +1,125 @@
+# Copyright (c) 2026 Taher AkbariSaeed
+import asyncio
+from scan_events import publish
+
+
+class ScanControl:
+    """Pause/resume/stop switch shared by every task working on one scan.
+
+    Paused tasks block on a single event instead of each polling the status
+    on a timer; stop wakes them, cancels every tracked task (closing their
+    tunnels and Xray cores on the way out) and is final. The status string
+    in the scan's state dict is kept in step for the API and the DB sync,
+    and every change is handed to `on_status`.
+    """
+
+    def __init__(self, state, on_status=None):
+        self.state = state
+        self.on_status = on_status
+        self._resumed = asyncio.Event()
+        self._stopped = asyncio.Event()
+        self._tasks = set()
+        self.cancelled = False
+        if state.get('status') != 'paused':
+            self._resumed.set()
+
+    @property
+    def status(self):
+        return self.state['status']
+
+    def _set_status(self, status):
+        self.state['status'] = status
+        if self.on_status:
+            self.on_status(status)
+
+    def is_running(self):
+        return not self._stopped.is_set() and self._resumed.is_set()
+
+    def is_stopped(self):
+        return self._stopped.is_set()
+
+    def pause(self):
+        if self._stopped.is_set() or not self._resumed.is_set():
+            return False
+        self._resumed.clear()
+        self._set_status('paused')
+        return True
+
+    def resume(self):
+        if self._stopped.is_set() or self._resumed.is_set():
+            return False
+        self._set_status('running')
+        self._resumed.set()
+        return True
+
+    def stop(self, status='stopped', cancel=True):
+        """Final: record `status` and release paused waiters.
+
+        With `cancel` every tracked task is cancelled too; without it they
+        only stop taking new steps and finish what they are doing.
+        """
+        if self._stopped.is_set():
+            return False
+        self._set_status(status)
+        self.cancelled = cancel
+        self._stopped.set()
+        self._resumed.set()
+        if cancel:
+            current = asyncio.current_task()
+            for task in list(self._tasks):
+                # A task that stops the scan finishes on its own
+                if task is not current:
+                    task.cancel()
+        return True
+
+    def track(self, task):
+        """Cancel `task` when the scan stops."""
+        if self._stopped.is_set():
+            task.cancel()
+            return task
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def wait_running(self):
+        """Block while paused; False once the scan has been stopped."""
+        if not self._resumed.is_set():
+            await self._resumed.wait()
+        return not self._stopped.is_set()
+
+    async def unless_stopped(self, aw):
+        """Await `aw`, giving up (and cancelling it) if the scan stops first.
+
+        Returns (True, result) when it finished, (False, None) when stopped.
+        """
+        task = asyncio.ensure_future(aw)
+        if self._stopped.is_set():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            return False, None
+        stopper = asyncio.ensure_future(self._stopped.wait())
+        try:
+            await asyncio.wait({task, stopper}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            stopper.cancel()
+            if not task.done():
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        if task.cancelled():
+            return False, None
+        return True, task.result()
+
+
+# scan_id -> ScanControl for scans with a live job behind them
+scan_controls = {}
+
+def create_control(scan_id, state):
+    control = ScanControl(state, on_status=lambda status: publish(scan_id, 'status', status))
+    scan_controls[scan_id] = control
+    return control
+
+def get_control(scan_id):
+    return scan_controls.get(scan_id)
+
+def drop_control(scan_id):
+    scan_controls.pop(scan_id, None)
@@ -0,0 +1,142 @@
+# Copyright (c) 2026 Taher AkbariSaeed
+import asyncio
+import copy
+from collections import deque
+
+# Only the latest value of these matters to a client, so repeats collapse
+COALESCED = ('status', 'stats')
+TERMINAL_STATUSES = ('completed', 'stopped', 'failed')
+
+
+class EventSubscriber:
+    """One client's view of a scan's event stream.
+
+    Log lines and results queue up in order, capped at `max_pending`; a
+    client that falls further behind loses them and is sent one 'resync'
+    event telling it to fetch the full state instead. Status and stats
+    only mark the subscriber dirty, so any number of changes between two
+    sends reach the client as a single event with the current value.
+    """
+
+    def __init__(self, max_pending=500):
+        self.pending = deque()
+        self.max_pending = max_pending
+        self.dirty = set(COALESCED)  # a new client starts with both
+        self.overflowed = False
+        self.ended = False
+        self._wakeup = asyncio.Event()
+        self._wakeup.set()
+
+    def push(self, kind, data=None):
+        if kind == 'end':
+            self.ended = True
+        elif kind in COALESCED:
+            self.dirty.add(kind)
+        elif not self.overflowed:
+            if len(self.pending) >= self.max_pending:
+                self.pending.clear()
+                self.overflowed = True
+            else:
+                self.pending.append({'type': kind, 'data': data})
+        self._wakeup.set()
+
+    async def wait(self, timeout):
+        """True when there is something to send, False after `timeout` idle seconds."""
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return False
+        self._wakeup.clear()
+        return True
+
+    def take(self, limit):
+        """Everything accumulated since the last take: (overflowed, events, dirty)."""
+        overflowed, self.overflowed = self.overflowed, False
+        events = [self.pending.popleft() for _ in range(min(limit, len(self.pending)))]
+        if self.pending:
+            self._wakeup.set()
+        dirty, self.dirty = self.dirty, set()
+        return overflowed, events, dirty
+
+
+# scan_id -> subscribers; normal, advanced and WARP scans share it (ids are uuids)
+_subscribers = {}
+
+def subscribe(scan_id, max_pending=500):
+    sub = EventSubscriber(max_pending)
+    _subscribers.setdefault(scan_id, set()).add(sub)
+    return sub
+
+def unsubscribe(scan_id, sub):
+    subs = _subscribers.get(scan_id)
+    if subs is not None:
+        subs.discard(sub)
+        if not subs:
+            del _subscribers[scan_id]
+
+def publish(scan_id, kind, data=None):
+    """Hand an event to every client of the scan; a dict lookup when there are none."""
+    subs = _subscribers.get(scan_id)
+    if subs:
+        for sub in subs:
+            sub.push(kind, data)
+
+
+def _delta(current, last):
+    """Top-level keys of `current` that changed since `last`, nested dicts key by key."""
+    changed = {}
+    for key, value in current.items():
+        if isinstance(value, dict):
+            before = last.get(key) or {}
+            inner = {k: v for k, v in value.items() if before.get(k) != v}
+            if inner:
+                changed[key] = inner
+        elif last.get(key) != value:
+            changed[key] = value
+    return changed
+
+
+async def pump(scan_id, send, snapshot, is_live, interval=0.1, batch=200, heartbeat=15.0):
+    """Stream one scan's events to a client through `send` until the scan ends.
+
+    `snapshot()` returns the scan's state dict (None once it is gone) and
+    is only read for status and stats; `is_live()` says whether a job is
+    still behind it. Sends are batched as {'events': [...]} at most every
+    `interval` seconds, which is what coalesces bursts. A slow client
+    simply makes each await of `send` take longer while its subscriber
+    absorbs, and if need be drops, what arrives meanwhile.
+    """
+    sub = subscribe(scan_id)
+    last = {}
+    try:
+        while True:
+            if not await sub.wait(heartbeat):
+                await send({'events': [{'type': 'heartbeat'}]})
+                continue
+            state = snapshot()
+            if state is None:
+                await send({'events': [{'type': 'end'}]})
+                return
+            overflowed, events, dirty = sub.take(batch)
+            if overflowed:
+                events.insert(0, {'type': 'resync'})
+            if 'status' in dirty and state.get('status') != last.get('status'):
+                last['status'] = state.get('status')
+                events.append({'type': 'status', 'data': last['status']})
+            if 'stats' in dirty:
+                current = {k: v for k, v in state.items() if k not in ('logs', 'status')}
+                changed = _delta(current, last.get('stats', {}))
+                if changed:
+                    # Deep: nested stats such as aimd are updated in place by the job
+                    last['stats'] = copy.deepcopy(current)
+                    events.append({'type': 'stats', 'data': changed})
+            finished = sub.ended or (state.get('status') in TERMINAL_STATUSES and not is_live())
+            if finished and not sub.pending:
+                events.append({'type': 'end'})
+            if events:
+                await send({'events': events})
+            if finished and not sub.pending:
+                return
+            await asyncio.sleep(interval)
+    finally:
+        unsubscribe(scan_id, sub)
@@ -0,0 +1,203 @@
+# Copyright (c) 2026 Taher AkbariSaeed
+import asyncio
+import time
+from aimd import CONGESTION_STATUSES
+
+
+class Candidate:
+    """One (ip, port) moving through the pipeline with its result so far."""
+
+    __slots__ = ("ip", "port", "result", "tunnel")
+
+    def __init__(self, ip, port=None, result=None):
+        self.ip = ip
+        self.port = port
+        self.result = result
+        self.tunnel = None
+
+
+class Stage:
+    """A pipeline step: `handler(candidate)` returns True to pass it on.
+
+    Each stage has its own bounded queue and worker count, so cheap checks
+    can run wide while the stages that hold a tunnel or move bytes stay
+    narrow. With a `controller` (see aimd) only `limit` of the workers may
+    be inside the handler at once, and the controller moves that limit from
+    the outcomes it is fed; `signal(candidate)` picks the latency it judges
+    (time spent in the handler by default).
+    """
+
+    def __init__(self, name, handler, workers, queue_size=None, controller=None, signal=None):
+        self.name = name
+        self.handler = handler
+        self.workers = max(1, int(workers))
+        self.queue_size = queue_size if queue_size is not None else self.workers * 2
+        self.controller = controller
+        self.signal = signal
+        self.limit = min(controller.limit, self.workers) if controller else self.workers
+        self.active = 0
+        self.passed = 0
+        self.dropped = 0
+        self._room = asyncio.Condition()
+
+    async def enter(self):
+        async with self._room:
+            await self._room.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+
+    async def leave(self):
+        async with self._room:
+            self.active -= 1
+            self._room.notify()
+
+    async def set_limit(self, limit):
+        async with self._room:
+            self.limit = max(1, min(limit, self.workers))
+            self._room.notify_all()
+
+
+class ScanPipeline:
+    """Runs candidates through a chain of stages, each with its own worker pool.
+
+    A candidate leaves the pipeline when a stage drops it or after the last
+    stage; either way its tunnel (if any) is closed and `on_done` is awaited
+    with it. Workers hold while the scan's `control` (see scan_control) is
+    paused; stopping it cancels them mid-step, so in-flight candidates are
+    discarded and their tunnels closed without reaching `on_done`.
+    """
+
+    def __init__(self, stages, on_done, control=None, on_decision=None):
+        self.stages = [s for s in stages if s is not None]
+        self.on_done = on_done
+        self.control = control
+        self.on_decision = on_decision
+        self._queues = [asyncio.Queue(maxsize=s.queue_size) for s in self.stages]
+        self._workers = []
+
+    def start(self):
+        for index, stage in enumerate(self.stages):
+            for _ in range(stage.workers):
+                task = asyncio.create_task(self._worker(index))
+                if self.control:
+                    self.control.track(task)
+                self._workers.append(task)
+
+    async def put(self, candidate):
+        """Feed the first stage, waiting while it is full; False if the scan stopped meanwhile."""
+        queue = self._queues[0]
+        if self.control is None:
+            await queue.put(candidate)
+            return True
+        if self.control.is_stopped():
+            return False
+        if not queue.full():
+            queue.put_nowait(candidate)
+            return True
+        done, _ = await self.control.unless_stopped(queue.put(candidate))
+        return done
+
+    async def _drain(self):
+        # Candidates only move forward, so draining queues in order drains all
+        for queue in self._queues:
+            await queue.join()
+
+    async def join(self):
+        """Wait until every fed candidate has left, or the scan stops."""
+        if self.control is None:
+            await self._drain()
+            return
+        done, _ = await self.control.unless_stopped(self._drain())
+        if not done and not self.control.cancelled:
+            # Soft stop: queued candidates are discarded, in-flight ones finish
+            await self._drain()
+
+    async def close(self, timeout=None):
+        """Cancel the workers and discard what is left, waiting at most `timeout` for them."""
+        for task in self._workers:
+            task.cancel()
+        if self._workers:
+            _, stuck = await asyncio.wait(self._workers, timeout=timeout)
+            if stuck:
+                # They still close their own tunnels when they get there
+                print(f"Pipeline close: {len(stuck)} workers still tearing down after {timeout}s")
+        self._workers = []
+        # Anything still queued was never picked up again
+        for queue in self._queues:
+            while not queue.empty():
+                await self._discard(queue.get_nowait())
+
+    async def _wait_running(self):
+        if self.control is None:
+            return True
+        return await self.control.wait_running()
+
+    async def _discard(self, candidate):
+        if candidate.tunnel is not None:
+            await candidate.tunnel.close()
+            candidate.tunnel = None
+
+    async def _finish(self, candidate):
+        await self._discard(candidate)
+        try:
+            await self.on_done(candidate)
+        except Exception as e:
+            print(f"Pipeline result handler failed for {candidate.ip}: {e}")
+
+    async def _feedback(self, stage, candidate, keep, elapsed_ms):
+        status = candidate.result.get('status') if candidate.result else None
+        failed = not keep and status in CONGESTION_STATUSES
+        latency = stage.signal(candidate) if stage.signal else elapsed_ms
+        decision = stage.controller.record(failed, latency)
+        if decision:
+            await stage.set_limit(stage.controller.limit)
+            if self.on_decision:
+                self.on_decision(stage.name, decision)
+
+    async def _worker(self, index):
+        stage = self.stages[index]
+        queue = self._queues[index]
+        is_last = index == len(self.stages) - 1
+        while True:
+            candidate = await queue.get()
+            handed_off = False
+            try:
+                if not await self._wait_running():
+                    continue
+                await stage.enter()
+                started = time.monotonic()
+                try:
+                    keep = await stage.handler(candidate)
+                except Exception as e:
+                    print(f"Stage {stage.name} failed for {candidate.ip}: {e}")
+                    keep = False
+                finally:
+                    await stage.leave()
+                if stage.controller:
+                    await self._feedback(stage, candidate, keep, (time.monotonic() - started) * 1000)
+                if keep:
+                    stage.passed += 1
+                else:
+                    stage.dropped += 1
+                if keep and not is_last:
+                    await self._queues[index + 1].put(candidate)
+                    handed_off = True
+                else:
+                    handed_off = True
+                    await self._finish(candidate)
+            finally:
+                if not handed_off:
+                    await self._discard(candidate)
+                queue.task_done()
+
+    def stats(self):
+        return {
+            stage.name: {
+                "workers": stage.workers,
+                "limit": stage.limit,
+                "active": stage.active,
+                "queued": self._queues[i].qsize(),
+                "passed": stage.passed,
+                "dropped": stage.dropped
+            }
+            for i, stage in enumerate(self.stages)
+        }
@@ -1,13 +1,12 @@
-import json
-import subprocess
 import time
 # Copyright (c) 2026 Taher AkbariSaeed
 import asyncio
 import aiohttp
 from aiohttp_socks import ProxyConnector
-import os
-import random
-from core_manager import get_xray_path, APP_DIR
+from core_manager import spawn_xray, reaper, wait_for_port
+from port_pool import reserve_port, release_port
+from latency_sampler import LatencySampler
+from speed_meter import ThroughputMeter, get_upload_payload
 import urllib.parse
 import socket
 import ssl
@@ -158,7 +157,8 @@ def generate_xray_config(vless_data, target_ip, local_port, test_port=None, frag
         })
 
     config = {
-        "log": {"loglevel": "none"},
+        # Warning level keeps the core's "started" line for readiness; access log stays off
+        "log": {"loglevel": "warning", "access": "none"},
         "inbounds": [{
             "port": local_port,
             "protocol": "socks",
@@ -207,77 +207,166 @@ async def tcp_ping(ip: str, port: int = 443, timeout: float = 2.0) -> bool:
     except Exception:
         return False
 
-async def measure_ping(session, url, check_status_cb=None):
-    if check_status_cb:
-        while check_status_cb() == 'paused':
-            await asyncio.sleep(0.5)
-        if check_status_cb() not in ['running', 'paused']:
-            return -1
+def open_proxy_session(local_port, streams=1):
+    """One keep-alive HTTP session through the candidate's socks inbound.
+
+    Readiness, pings, trace and speed tests all share it, so the tunnel only
+    pays for a new TLS/VLESS handshake per host instead of per request.
+    Names are resolved on the far side (rdns), so there is no local DNS
+    lookup per connection to cache in the first place. `streams` lifts the
+    per-host limit for multi-stream speed tests.
+    """
+    connector = ProxyConnector.from_url(
+        f"socks5://127.0.0.1:{local_port}",
+        rdns=True,
+        limit=max(2, streams) + 2,
+        limit_per_host=max(2, streams),
+        keepalive_timeout=30,
+        enable_cleanup_closed=True
+    )
+    return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=30))
+
+async def measure_ping(session, url, control=None, timeout=12):
+    if not await still_running(control):
+        return -1
 
     start = time.time()
     try:
-        async with session.get(url, timeout=12) as response:
+        async with session.get(url, timeout=timeout) as response:
             if response.status == 204 or response.status == 200:
                 duration = (time.time() - start) * 1000
+                # Drain the body so the connection goes back to the pool
+                await response.read()
                 return duration
     except Exception as e:
         # print(f"Ping Error: {e}")
         return -1
     return -1
 
-def check_tls_cert_sync(ip, port=443, sni=None):
-    try:
+_tls_context = None
+
+def get_tls_context():
+    """Verifying client context, built once and shared by every TLS probe."""
+    global _tls_context
+    if _tls_context is None:
         ctx = ssl.create_default_context()
         ctx.check_hostname = False
-        with socket.create_connection((ip, port), timeout=3) as sock:
-            with ctx.wrap_socket(sock, server_hostname=sni or "cloudflare.com") as ssock:
-                cert = ssock.getpeercert()
-                issuer = dict(x[0] for x in cert.get('issuer', []))
-                org = issuer.get('organizationName', '')
-                subject = dict(x[0] for x in cert.get('subject', []))
-                subj_cn = subject.get('commonName', '')
-                
-                valid_orgs = ['Cloudflare', 'Google Trust Services', "Let's Encrypt", 'DigiCert', 'GlobalSign']
-                is_valid_org = any(vo in org for vo in valid_orgs)
-                is_valid_subj = 'cloudflare' in subj_cn.lower() or 'sni.cloudflaressl.com' in subj_cn.lower()
-                
-                return is_valid_org or is_valid_subj
-    except Exception as e:
-        return False
+        _tls_context = ctx
+    return _tls_context
+
+def is_cloudflare_cert(cert):
+    issuer = dict(x[0] for x in cert.get('issuer', []))
+    org = issuer.get('organizationName', '')
+    subject = dict(x[0] for x in cert.get('subject', []))
+    subj_cn = subject.get('commonName', '')
+    
+    valid_orgs = ['Cloudflare', 'Google Trust Services', "Let's Encrypt", 'DigiCert', 'GlobalSign']
+    is_valid_org = any(vo in org for vo in valid_orgs)
+    is_valid_subj = 'cloudflare' in subj_cn.lower() or 'sni.cloudflaressl.com' in subj_cn.lower()
+    
+    return is_valid_org or is_valid_subj
+
+async def probe_tls_cert(ip, port=443, sni=None, timeout=3.0):
+    """Connect and handshake on the event loop; RTTs, issuer and subject in one pass."""
+    info = {"valid": False, "tcp_rtt": -1, "tls_rtt": -1, "issuer": "", "subject": ""}
+    loop = asyncio.get_running_loop()
+    sock = socket.socket(socket.AF_INET6 if ':' in ip else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    writer = None
+    try:
+        start = time.time()
+        await asyncio.wait_for(loop.sock_connect(sock, (ip, port)), timeout=timeout)
+        connected = time.time()
+        info["tcp_rtt"] = round((connected - start) * 1000, 2)
+        _, writer = await asyncio.wait_for(
+            asyncio.open_connection(sock=sock, ssl=get_tls_context(), server_hostname=sni or "cloudflare.com", ssl_handshake_timeout=timeout),
+            timeout=timeout
+        )
+        info["tls_rtt"] = round((time.time() - connected) * 1000, 2)
+        cert = writer.get_extra_info('peercert') or {}
+        info["issuer"] = dict(x[0] for x in cert.get('issuer', [])).get('organizationName', '')
+        info["subject"] = dict(x[0] for x in cert.get('subject', [])).get('commonName', '')
+        info["valid"] = is_cloudflare_cert(cert)
+    except Exception:
+        pass
+    finally:
+        if writer is not None:
+            # No close_notify round trip, the probe is done with this connection
+            writer.transport.abort()
+        else:
+            sock.close()
+    return info
 
 async def verify_cloudflare_tls(ip, port=443, sni=None):
-    return await asyncio.to_thread(check_tls_cert_sync, ip, port, sni)
+    info = await probe_tls_cert(ip, port, sni)
+    return info["valid"]
 
-async def measure_speed(session, url, size_mb=1, is_upload=False, check_status_cb=None):
-    if check_status_cb:
-        while check_status_cb() == 'paused':
-            await asyncio.sleep(0.5)
-        if check_status_cb() not in ['running', 'paused']:
-            return 0
+async def _upload_body(meter, size_bytes, sent):
+    async for piece in get_upload_payload().chunks(size_bytes):
+        yield piece
+        # Resumed: the writer has taken the previous piece (not that it arrived)
+        sent[0] += len(piece)
+        if meter.update(len(piece)):
+            return
 
-    start = time.time()
+async def _transfer(session, url, meter, size_bytes, is_upload, timeout):
+    """One stream of a measurement; False if the server refused it or it failed before any byte moved."""
+    moved = [0]
     try:
         if is_upload:
-            # Upload 1MB
-            data = b'0' * (1024 * 1024 * size_mb) 
-            async with session.post(url, data=data, timeout=25) as response:
-                 # Accept 200 or 204 or even others if stream worked
-                if response.status < 400:
-                    duration = time.time() - start
-                    if duration > 0:
-                        speed_mbps = (size_mb * 8) / duration
-                        return speed_mbps
-        else:
-            # Download
-            async with session.get(url, timeout=25) as response:
-                 await response.read()
-                 duration = time.time() - start
-                 if duration > 0:
-                     speed_mbps = (size_mb * 8) / duration
-                     return speed_mbps
-    except Exception as e:
-        pass
-    return 0
+            async with session.post(url, data=_upload_body(meter, size_bytes, moved), timeout=timeout) as response:
+                await response.read()
+                # Accept 200 or 204 or even others if stream worked
+                if response.status >= 400:
+                    return False
+                # The server has answered, so the body has actually arrived
+                meter.delivered(moved[0])
+                return True
+        async with session.get(url, timeout=timeout) as response:
+            if response.status >= 400:
+                return False
+            while True:
+                try:
+                    data = await asyncio.wait_for(response.content.readany(), timeout=0.5)
+                except asyncio.TimeoutError:
+                    # Stalled: the projection may already rule this one out
+                    if meter.check():
+                        break
+                    continue
+                if not data:
+                    break
+                moved[0] += len(data)
+                if meter.update(len(data)):
+                    break
+    except Exception:
+        # e.g. connection refused: nothing was measured on this stream
+        return moved[0] > 0
+    return True
+
+async def measure_throughput(session, url, size_bytes=1000000, is_upload=False, min_mbps=0, control=None, timeout=25, streams=1):
+    """Stream a transfer through a ThroughputMeter; returns its summary.
+
+    Stops reading (or sending) as soon as the meter aborts or converges, so
+    slow candidates don't burn the whole body and the timeout. With
+    streams > 1 that many transfers of `size_bytes` run in parallel through
+    the session and the meter rates their combined bytes, so a path that
+    never leaves slow start on one connection is still measured fairly.
+    Upload rates only count bytes the server has answered for, timed up to
+    its last response.
+    """
+    meter = ThroughputMeter(size_bytes * streams, min_mbps=min_mbps, delivery=is_upload)
+    if not await still_running(control):
+        return meter.summary()
+
+    meter.start()
+    accepted = await asyncio.gather(*(_transfer(session, url, meter, size_bytes, is_upload, timeout) for _ in range(streams)))
+    if not any(accepted):
+        return ThroughputMeter(size_bytes).summary()
+    return meter.summary()
+
+async def measure_speed(session, url, size_mb=1, is_upload=False, control=None, min_mbps=0):
+    summary = await measure_throughput(session, url, size_bytes=size_mb * 1000000, is_upload=is_upload, min_mbps=min_mbps, control=control)
+    return summary["mbps"]
 
 def reconstruct_vless(parts, new_ip):
     # Rebuild the VLESS URL with the new IP
@@ -291,48 +380,8 @@ def reconstruct_vless(parts, new_ip):
     url = f"{base}?{query}#IP-{new_ip}"
     return url
 
-async def scan_ip(ip, vless_parts, thresholds, speed_sem=None, test_port=None, fragment=None, test_sni=None, verify_tls=False, check_status_cb=None, provider="cloudflare", advanced_dns_config=None):
-    ip = ip.strip()
-    if not ip: return {"status": "error"}
-    
-    if check_status_cb:
-        while check_status_cb() == 'paused':
-            await asyncio.sleep(0.5)
-        if check_status_cb() not in ['running', 'paused']:
-            return {"status": "abort"}
-    
-    local_port = random.randint(10000, 20000)
-    config = generate_xray_config(vless_parts, ip, local_port, test_port=test_port, fragment=fragment, test_sni=test_sni, advanced_dns_config=advanced_dns_config)
-    
-    safe_ip = ip.replace(":", "_")
-    config_path = os.path.join(APP_DIR, f"config_{safe_ip}_{local_port}.json")
-    with open(config_path, "w") as f:
-        json.dump(config, f, indent=2)
-        
-    xray_path = get_xray_path()
-    
-    # Hide terminal window on Windows Pyinstaller builds
-    creationflags = 0
-    if os.name == 'nt':
-        creationflags = subprocess.CREATE_NO_WINDOW
-        
-    process = subprocess.Popen([xray_path, "-c", config_path], stdout=subprocess.PIPE, stderr=subprocess.PIPE, creationflags=creationflags)
-    
-    # FIX #3: Adaptive Xray boot - poll readiness instead of fixed 2s wait
-    connector = ProxyConnector.from_url(f"socks5://127.0.0.1:{local_port}")
-    xray_ready = False
-    for _ in range(10):  # Up to 5 seconds (10 x 500ms)
-        await asyncio.sleep(0.5)
-        try:
-            async with aiohttp.ClientSession(connector=ProxyConnector.from_url(f"socks5://127.0.0.1:{local_port}")) as probe:
-                async with probe.get("http://cp.cloudflare.com/generate_204", timeout=2) as r:
-                    if r.status in [200, 204]:
-                        xray_ready = True
-                        break
-        except:
-            pass
-    
-    result = {
+def new_result(ip):
+    return {
         "ip": ip, 
         "ping": -1, 
         "jitter": -1, 
@@ -342,182 +391,255 @@ async def scan_ip(ip, vless_parts, thresholds, speed_sem=None, test_port=None, f
         "datacenter": "Unknown",
         "link": ""
     }
+
+async def still_running(control):
+    """Hold while the scan is paused; False once it has been stopped."""
+    if control is None:
+        return True
+    return await control.wait_running()
+
+class Tunnel:
+    """Socks inbound for one candidate plus the session riding on it.
+
+    Backed by either a leased engine slot or a private Xray core; close()
+    gives back whichever it holds.
+    """
+
+    def __init__(self, local_port, process=None, lease=None, engine=None):
+        self.local_port = local_port
+        self.process = process
+        self.lease = lease
+        self.engine = engine
+        self.session = None
+
+    async def close(self):
+        if self.session is not None:
+            try:
+                await self.session.close()
+            except Exception:
+                pass
+            self.session = None
+        if self.lease is not None:
+            self.engine.release(self.lease)
+            self.lease = None
+        elif self.process is not None:
+            # Non-blocking: the shared reaper kills and collects the child
+            reaper.reap(self.process)
+            release_port(self.local_port)
+            self.process = None
+
+async def open_tunnel(ip, vless_parts, result, test_port=None, fragment=None, test_sni=None, advanced_dns_config=None, engine=None, streams=1):
+    """Bring up the socks inbound for `ip`; sets result status and returns None on failure."""
+    if engine is not None:
+        # Shared multi-target core: no per-IP process or config file
+        try:
+            lease = await engine.acquire(ip, test_port)
+        except Exception:
+            # Local failure (core boot, port pool, closed engine), not the target's
+            result["status"] = "error"
+            return None
+        tunnel = Tunnel(lease.local_port, lease=lease, engine=engine)
+    else:
+        try:
+            local_port = reserve_port()
+        except RuntimeError:
+            result["status"] = "error"
+            return None
+        config = generate_xray_config(vless_parts, ip, local_port, test_port=test_port, fragment=fragment, test_sni=test_sni, advanced_dns_config=advanced_dns_config)
+        try:
+            # Config goes over stdin; nothing is written to APP_DIR per candidate
+            process = await spawn_xray(config, label=f"scan {ip}")
+        except asyncio.CancelledError:
+            release_port(local_port)
+            raise
+        except Exception:
+            release_port(local_port)
+            result["status"] = "error"
+            return None
+        tunnel = Tunnel(local_port, process=process)
+        # Core readiness: the local socks inbound answers within tens of ms of boot.
+        # Engine leases are already live; upstream reachability is probed with the first ping.
+        try:
+            ready = await wait_for_port(local_port, process=process, timeout=5.0, socks=True)
+        except BaseException:
+            # Stopped mid-boot: the caller never sees the tunnel, so reap it here
+            await tunnel.close()
+            raise
+        if not ready:
+            await tunnel.close()
+            result["status"] = "error"
+            return None
+    tunnel.session = open_proxy_session(tunnel.local_port, streams)
+    return tunnel
+
+async def probe_tls(ip, vless_parts, result, test_port=None, test_sni=None):
+    tls = await probe_tls_cert(ip, port=test_port or vless_parts.get('port', 443), sni=test_sni or vless_parts['params'].get('sni'))
+    if tls["tls_rtt"] != -1:
+        result["tls_rtt"] = tls["tls_rtt"]
+    if not tls["valid"]:
+        result["status"] = "compromised"
+        return False
+    return True
+
+async def probe_latency(session, result, thresholds, control=None):
+    """Warmup, ping and jitter through the tunnel; False if the candidate fails."""
+    test_url = "http://cp.cloudflare.com/generate_204"
     
+    # Upstream reachability: first request through the tunnel, fast retry backoff
+    warmup_success = False
+    retry_delay = 0.1
+    for _ in range(4):
+        if await measure_ping(session, test_url, control, timeout=5) != -1:
+            warmup_success = True
+            break
+        await asyncio.sleep(retry_delay)
+        retry_delay *= 2
+    
+    if not warmup_success:
+        # The tunnel or upstream failed, which says nothing about the IP's /24
+        result["status"] = "tunnel_unreachable"
+        return False
+    
+    # FIX #5: Post-warmup cooldown - let TLS session stabilize
+    await asyncio.sleep(0.5)
+
+    # Sequential test: stop as soon as the samples settle either side of the thresholds
+    sampler = LatencySampler(thresholds.get("max_ping", 1000), thresholds.get("max_jitter", 1000))
+    cold = True
+    verdict = None
+    for _ in range(sampler.max_samples + 2):
+        p = await measure_ping(session, test_url, control)
+        if p != -1:
+            if cold:
+                cold = False  # FIX #1: Discard first ping (cold-start TLS overhead)
+            else:
+                sampler.add(p)
+                verdict = sampler.decision()
+                if verdict:
+                    break
+        await asyncio.sleep(0.2)
+    
+    if not sampler.samples:
+        result["status"] = "timeout"
+        return False
+    
+    result.update(sampler.summary())
+    verdict = verdict or sampler.final()
+    if verdict != "ok":
+        result["status"] = verdict
+        return False
+    return True
+
+async def probe_colo(session, result, provider="cloudflare"):
+    # Extract Datacenter Colo
+    if provider == 'fastly':
+        # Fastly POP check
+        try:
+            async with session.get("http://www.fastly.com", timeout=5) as t_resp:
+                if 'x-served-by' in t_resp.headers:
+                    served_by = t_resp.headers['x-served-by']
+                    # extract POP, e.g. cache-iad-kiad7000185-IAD -> IAD
+                    parts = served_by.split('-')
+                    if len(parts) >= 2:
+                        result["datacenter"] = "Fastly-" + parts[-1].upper()
+                    else:
+                        result["datacenter"] = "Fastly-Edge"
+                else:
+                    result["datacenter"] = "Fastly-Edge"
+        except Exception:
+            result["datacenter"] = "Fastly-Edge"
+    else:
+        # Default Cloudflare Colo Check
+        try:
+            async with session.get("http://cp.cloudflare.com/cdn-cgi/trace", timeout=5) as t_resp:
+                if t_resp.status == 200:
+                    trace_text = await t_resp.text()
+                    for line in trace_text.splitlines():
+                        if line.startswith("colo="):
+                            result["datacenter"] = line.split("=")[1].strip()
+                            break
+        except Exception:
+            pass
+    return True
+
+async def probe_throughput(session, ip, vless_parts, result, thresholds, control=None, streams=1):
+    min_download = thresholds.get("min_download", 0)
+    min_upload = thresholds.get("min_upload", 0)
+    
+    # 2. DOWNLOAD SPEED: streamed, aborts once the threshold is out of reach.
+    # FIX #2: Best-of-2, but only when the first run fell short
+    download_url = "http://speed.cloudflare.com/__down?bytes=1000000" 
+    down = await measure_throughput(session, download_url, 1000000, min_mbps=min_download, control=control, streams=streams)
+    if down["mbps"] <= 0 or down["mbps"] < min_download:
+        retry = await measure_throughput(session, download_url, 1000000, min_mbps=min_download, control=control, streams=streams)
+        if retry["mbps"] > down["mbps"]:
+            down = retry
+    speed_down = down["mbps"]
+    result["download"] = round(speed_down, 2)
+    result["ttfb"] = down["ttfb"]
+    
+    if speed_down <= 0 or speed_down < min_download:
+        result["status"] = "low_download"
+        return False
+
+    # 3. UPLOAD SPEED (same rules)
+    upload_url = "http://speed.cloudflare.com/__up"
+    up = await measure_throughput(session, upload_url, 1000000, is_upload=True, min_mbps=min_upload, control=control, streams=streams)
+    if up["mbps"] <= 0 or up["mbps"] < min_upload:
+        retry = await measure_throughput(session, upload_url, 1000000, is_upload=True, min_mbps=min_upload, control=control, streams=streams)
+        if retry["mbps"] > up["mbps"]:
+            up = retry
+    speed_up = up["mbps"]
+    result["upload"] = round(speed_up, 2)
+    
+    if speed_up <= 0 or speed_up < min_upload:
+        result["status"] = "low_upload"
+        return False
+
+    # PASSED ALL
+    result["status"] = "ok"
+    result["link"] = reconstruct_vless(vless_parts, ip)
+    return True
+
+async def scan_ip(ip, vless_parts, thresholds, speed_sem=None, test_port=None, fragment=None, test_sni=None, verify_tls=False, control=None, provider="cloudflare", advanced_dns_config=None, engine=None, speed_streams=1):
+    """All probe stages for one candidate, back to back.
+
+    Scan jobs run the same stages through scan_pipeline instead, so each one
+    gets its own queue and worker budget.
+    """
+    ip = ip.strip()
+    if not ip: return {"status": "error"}
+    
+    if not await still_running(control):
+        return {"status": "abort"}
+    
+    result = new_result(ip)
+    
+    # Certificate check goes direct to the IP, so it runs before paying for a core
     if verify_tls:
-        if check_status_cb:
-            while check_status_cb() == 'paused':
-                await asyncio.sleep(0.5)
-            if check_status_cb() not in ['running', 'paused']:
-                result["status"] = "abort"
-                return result
-
-        is_valid_tls = await verify_cloudflare_tls(ip, port=test_port or vless_parts.get('port', 443), sni=test_sni or vless_parts['params'].get('sni'))
-        if not is_valid_tls:
-            result["status"] = "compromised"
+        if not await still_running(control):
+            result["status"] = "abort"
             return result
-
+        if not await probe_tls(ip, vless_parts, result, test_port=test_port, test_sni=test_sni):
+            return result
+    
+    tunnel = await open_tunnel(ip, vless_parts, result, test_port=test_port, fragment=fragment, test_sni=test_sni, advanced_dns_config=advanced_dns_config, engine=engine, streams=speed_streams)
+    if tunnel is None:
+        return result
+    
     try:
-        async with aiohttp.ClientSession(connector=connector) as session:
-            # 1. PING & JITTER
-            pings = []
-            test_url = "http://cp.cloudflare.com/generate_204"
-            
-            # Warmup with Retry (skip if adaptive boot already confirmed)
-            if not xray_ready:
-                warmup_success = False
-                for _ in range(5):
-                    if await measure_ping(session, test_url, check_status_cb) != -1:
-                        warmup_success = True
-                        break
-                    await asyncio.sleep(2)
-                
-                if not warmup_success:
-                     result["status"] = "unreachable"
-                     raise Exception("Warmup failed")
-            
-            # FIX #5: Post-warmup cooldown - let TLS session stabilize
-            await asyncio.sleep(0.5)
-
-            # FIX #1: Run 6 pings, drop the first (cold-start TLS overhead)
-            for i in range(6):
-                p = await measure_ping(session, test_url, check_status_cb)
-                if p != -1:
-                    if i == 0:
-                        pass  # Discard first ping (cold-start bias)
-                    else:
-                        pings.append(p)
-                await asyncio.sleep(0.2)
-            
-            if not pings:
-                 result["status"] = "timeout"
-                 raise Exception("All pings failed")
-
-            avg_ping = sum(pings) / len(pings)
-            jitter = max(pings) - min(pings)
-            result["ping"] = round(avg_ping, 2)
-            result["jitter"] = round(jitter, 2)
-            
-            # Extract Datacenter Colo
-            if provider == 'fastly':
-                 # Fastly POP check
-                 try:
-                     async with session.get("http://www.fastly.com", timeout=5) as t_resp:
-                         if 'x-served-by' in t_resp.headers:
-                             served_by = t_resp.headers['x-served-by']
-                             # extract POP, e.g. cache-iad-kiad7000185-IAD -> IAD
-                             parts = served_by.split('-')
-                             if len(parts) >= 2:
-                                  result["datacenter"] = "Fastly-" + parts[-1].upper()
-                             else:
-                                  result["datacenter"] = "Fastly-Edge"
-                         else:
-                             result["datacenter"] = "Fastly-Edge"
-                 except:
-                     result["datacenter"] = "Fastly-Edge"
-            else:
-                 # Default Cloudflare Colo Check
-                 try:
-                     async with session.get("http://cp.cloudflare.com/cdn-cgi/trace", timeout=5) as t_resp:
-                         if t_resp.status == 200:
-                             trace_text = await t_resp.text()
-                             for line in trace_text.splitlines():
-                                 if line.startswith("colo="):
-                                     result["datacenter"] = line.split("=")[1].strip()
-                                     break
-                 except:
-                     pass
-            
-            # FIX #4: Borderline retry - 10% grace margin
-            max_ping_threshold = thresholds.get("max_ping", 1000)
-            max_jitter_threshold = thresholds.get("max_jitter", 1000)
-            
-            # FAIL-FAST CHECK: PING (with grace margin retry)
-            if avg_ping > max_ping_threshold:
-                # If within 10% grace, retry once
-                if avg_ping <= max_ping_threshold * 1.1:
-                    retry_pings = []
-                    for _ in range(3):
-                        p = await measure_ping(session, test_url, check_status_cb)
-                        if p != -1:
-                            retry_pings.append(p)
-                        await asyncio.sleep(0.2)
-                    if retry_pings:
-                        avg_ping = sum(retry_pings) / len(retry_pings)
-                        result["ping"] = round(avg_ping, 2)
-                if avg_ping > max_ping_threshold:
-                    result["status"] = "high_ping"
-                    return result
-            
-            # FAIL-FAST CHECK: JITTER (with grace margin retry)
-            if jitter > max_jitter_threshold:
-                if jitter <= max_jitter_threshold * 1.1:
-                    retry_pings = []
-                    for _ in range(3):
-                        p = await measure_ping(session, test_url, check_status_cb)
-                        if p != -1:
-                            retry_pings.append(p)
-                        await asyncio.sleep(0.2)
-                    if len(retry_pings) >= 2:
-                        jitter = max(retry_pings) - min(retry_pings)
-                        result["jitter"] = round(jitter, 2)
-                if jitter > max_jitter_threshold:
-                    result["status"] = "high_jitter"
-                    return result
-
-            sem_ctx = speed_sem if speed_sem else asyncio.Semaphore(1)
-            
-            async with sem_ctx:
-                 # FIX #2: Best-of-2 speed tests
-                 download_url = "http://speed.cloudflare.com/__down?bytes=1000000" 
-                 
-                 # 2. DOWNLOAD SPEED (best of 2)
-                 speed_down_1 = await measure_speed(session, download_url, size_mb=1, is_upload=False, check_status_cb=check_status_cb)
-                 speed_down_2 = await measure_speed(session, download_url, size_mb=1, is_upload=False, check_status_cb=check_status_cb)
-                 speed_down = max(speed_down_1, speed_down_2)
-                 result["download"] = round(speed_down, 2)
-                 
-                 if speed_down <= 0 or speed_down < thresholds.get("min_download", 0):
-                     result["status"] = "low_download"
-                     return result
-
-                 # 3. UPLOAD SPEED (best of 2)
-                 upload_url = "http://speed.cloudflare.com/__up"
-                 speed_up_1 = await measure_speed(session, upload_url, size_mb=1, is_upload=True, check_status_cb=check_status_cb)
-                 speed_up_2 = await measure_speed(session, upload_url, size_mb=1, is_upload=True, check_status_cb=check_status_cb)
-                 speed_up = max(speed_up_1, speed_up_2)
-                 result["upload"] = round(speed_up, 2)
-                 
-                 if speed_up <= 0 or speed_up < thresholds.get("min_upload", 0):
-                     result["status"] = "low_upload"
-                     return result
-
-                 # PASSED ALL
-                 result["status"] = "ok"
-                 result["link"] = reconstruct_vless(vless_parts, ip)
+        if not await probe_latency(tunnel.session, result, thresholds, control):
+            return result
+        await probe_colo(tunnel.session, result, provider)
+        
+        sem_ctx = speed_sem if speed_sem else asyncio.Semaphore(1)
+        async with sem_ctx:
+            await probe_throughput(tunnel.session, ip, vless_parts, result, thresholds, control, streams=speed_streams)
 
     except Exception as e:
         # print(f"Scan fatal error {ip}: {e}")
         pass
     finally:
-        import psutil
-        try:
-            parent = psutil.Process(process.pid)
-            for child in parent.children(recursive=True):
-                child.kill()
-            parent.kill()
-            parent.wait(timeout=2)
-        except psutil.NoSuchProcess:
-            pass
-        except Exception:
-            try:
-                 process.terminate()
-                 process.wait(timeout=1)
-            except:
-                 pass
-
-        try:
-            os.remove(config_path)
-        except:
-            pass
+        await tunnel.close()
             
     return result
@@ -0,0 +1,172 @@
+# Copyright (c) 2026 Taher AkbariSaeed
+import os
+import time
+
+
+class ThroughputMeter:
+    """Streaming rate meter for one transfer, fed chunk sizes as they move.
+
+    Rates are measured from the first byte, so time-to-first-byte is
+    reported separately instead of dragging the Mbps figure down. update()
+    and check() return 'abort' once even an optimistic finish (twice the
+    best window rate so far) can no longer reach `min_mbps`, 'converged'
+    once the last few window rates agree within `tolerance`, 'done' when
+    `total_bytes` have moved, and None otherwise.
+
+    With `delivery=True` (uploads) the bytes fed in are only handed to the
+    local socket, not received, so window rates are used for the abort
+    projection alone: the meter never converges or finishes on its own.
+    Each stream reports its bytes through delivered() once the server has
+    answered, and the rate is those bytes over the time from start() to
+    the last answer.
+    """
+
+    def __init__(self, total_bytes, min_mbps=0, window=0.1, settle=0.4, tolerance=0.15, grace=0.3, ttfb_timeout=5.0, delivery=False):
+        self.total_bytes = total_bytes
+        self.delivery = delivery
+        self.confirmed = 0
+        self.min_mbps = min_mbps
+        self.window = window
+        self.settle = settle
+        self.tolerance = tolerance
+        self.grace = grace
+        self.ttfb_timeout = ttfb_timeout
+        self.started = None
+        self.first_byte = None
+        self.bytes = 0
+        self.windows = []  # completed window rates in Mbps
+        self._window_start = None
+        self._window_bytes = 0
+        self.state = None
+        self.ended = None
+
+    def start(self):
+        self.started = time.monotonic()
+
+    def _roll(self, now):
+        while now - self._window_start >= self.window:
+            self.windows.append(self._window_bytes * 8 / self.window / 1e6)
+            self._window_bytes = 0
+            self._window_start += self.window
+
+    def update(self, nbytes):
+        now = time.monotonic()
+        if self.first_byte is None:
+            self.first_byte = now
+            self._window_start = now
+        else:
+            self._roll(now)
+        self.bytes += nbytes
+        self._window_bytes += nbytes
+        return self._judge(now)
+
+    def check(self):
+        """Re-evaluate without new bytes, e.g. while the transfer is stalled."""
+        now = time.monotonic()
+        if self.first_byte is not None:
+            self._roll(now)
+        return self._judge(now)
+
+    def delivered(self, nbytes):
+        """Record that the server has received `nbytes` of an upload."""
+        now = time.monotonic()
+        self.confirmed += nbytes
+        self.ended = now
+        if self.state is None and self.confirmed >= self.total_bytes:
+            self.state = "done"
+
+    def _judge(self, now):
+        if self.delivery:
+            # In-flight numbers only justify stopping early, never finishing
+            if self.state is None:
+                self._project(now)
+                if self.state is not None:
+                    self.ended = now
+            return self.state
+        if self.bytes >= self.total_bytes:
+            self.state = "done"
+        else:
+            self._project(now)
+            if self.state is None and self.first_byte is not None and now - self.first_byte >= self.settle and len(self.windows) >= 4:
+                recent = self.windows[-4:]
+                mean = sum(recent) / len(recent)
+                if mean > 0 and (max(recent) - min(recent)) / mean <= self.tolerance:
+                    self.state = "converged"
+        if self.state is not None and self.ended is None:
+            self.ended = now
+        return self.state
+
+    def _project(self, now):
+        if self.first_byte is None:
+            if now - self.started > self.ttfb_timeout:
+                self.state = "abort"
+            return
+        flowing = now - self.first_byte
+        if self.min_mbps > 0 and flowing >= self.grace:
+            optimistic = max(self.windows or [0]) * 2 * 1e6 / 8
+            remaining = self.total_bytes - self.bytes
+            finish = flowing + (remaining / optimistic if optimistic > 0 else float('inf'))
+            if self.total_bytes * 8 / finish / 1e6 < self.min_mbps:
+                self.state = "abort"
+
+    def ttfb(self):
+        if self.first_byte is None:
+            return -1
+        return (self.first_byte - self.started) * 1000
+
+    def mbps(self):
+        if self.delivery:
+            if self.confirmed == 0 or self.ended is None:
+                return 0
+            duration = self.ended - self.started
+            return self.confirmed * 8 / duration / 1e6 if duration > 0 else 0
+        if self.state == "converged":
+            recent = self.windows[-4:]
+            return sum(recent) / len(recent)
+        if self.first_byte is None or self.bytes == 0:
+            return 0
+        now = self.ended or time.monotonic()
+        flowing = now - self.first_byte
+        # A body that lands in one or two reads has no meaningful flow time
+        duration = flowing if flowing >= self.window else now - self.started
+        return self.bytes * 8 / duration / 1e6 if duration > 0 else 0
+
+    def summary(self):
+        return {
+            "mbps": self.mbps(),
+            "ttfb": round(self.ttfb(), 2),
+            "bytes": self.confirmed if self.delivery else self.bytes,
+            "state": self.state or "incomplete"
+        }
+
+
+class UploadPayload:
+    """Shared, pre-built upload body handed out as read-only memoryview slices.
+
+    The block is random so compressing middleboxes can't shrink it, and it
+    is allocated once: every upload in every scan reads from the same
+    buffer, so memory stays flat however many run in parallel. Totals
+    larger than the block wrap around it.
+    """
+
+    def __init__(self, block_size=1024 * 1024):
+        self._view = memoryview(os.urandom(block_size)).toreadonly()
+
+    async def chunks(self, total_bytes, chunk_size=64 * 1024):
+        size = len(self._view)
+        offset = 0
+        remaining = total_bytes
+        while remaining > 0:
+            n = min(chunk_size, remaining, size - offset)
+            yield self._view[offset:offset + n]
+            remaining -= n
+            offset = (offset + n) % size
+
+
+_upload_payload = None
+
+def get_upload_payload():
+    global _upload_payload
+    if _upload_payload is None:
+        _upload_payload = UploadPayload()
+    return _upload_payload
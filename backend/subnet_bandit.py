@@ -0,0 +1,124 @@
+# Copyright (c) 2026 Taher AkbariSaeed
+import heapq
+import random
+
+
+class SubnetBandit:
+    """Thompson-sampling split of probes between good /24s and exploration.
+
+    Outcomes are counted per /24 block (only blocks that have produced a
+    good IP are arms, so the table stays as small as the hits), per parent
+    range, and for exploration as a whole. Each decision draws a yield
+    from every arm's Beta posterior and from exploration's, and the
+    highest draw gets the probe: a block that keeps paying off wins most
+    draws, one that stops doing so fades out, and exploration is never
+    starved. A block's prior leans on its parent range's record, and
+    every prior is centred on the scan's overall hit rate rather than
+    50%, which would badly overrate unknown arms when hits are rare.
+    """
+
+    def __init__(self, prior_weight=10, rng=None):
+        self.prior_weight = prior_weight
+        self.rng = rng or random.Random()
+        self.blocks = {}  # block key -> [good, bad]
+        self.ranges = {}  # range key -> [good, bad]
+        self.explore = [0, 0]
+        self.total = [0, 0]
+
+    def _prior(self):
+        good, bad = self.total
+        rate = (good + 1) / (good + bad + 2)
+        return 0.5 + self.prior_weight * rate, 0.5 + self.prior_weight * (1 - rate)
+
+    def _range_prior(self, range_key):
+        alpha, beta = self._prior()
+        stats = self.ranges.get(range_key)
+        if not stats:
+            return alpha, beta
+        good, bad = stats
+        # The range's own rate, shrunk towards the global one
+        rate = (good + alpha) / (good + bad + alpha + beta)
+        return 0.5 + self.prior_weight * rate, 0.5 + self.prior_weight * (1 - rate)
+
+    def add_block(self, key, good=1, bad=0):
+        """Make a block an arm, e.g. one seeded from history with a pseudo-hit."""
+        if key not in self.blocks:
+            self.blocks[key] = [good, bad]
+
+    def drop_block(self, key):
+        self.blocks.pop(key, None)
+
+    def choose(self, candidates, range_of):
+        """The block key to probe next, or None to explore.
+
+        `candidates` are block keys that still have untried addresses and
+        `range_of(key)` gives a block's parent range key (or None).
+        """
+        alpha, beta = self._prior()
+        best = None
+        best_draw = self.rng.betavariate(alpha + self.explore[0], beta + self.explore[1])
+        for key in candidates:
+            good, bad = self.blocks[key]
+            a, b = self._range_prior(range_of(key))
+            draw = self.rng.betavariate(a + good, b + bad)
+            if draw > best_draw:
+                best, best_draw = key, draw
+        return best
+
+    def shortlist(self, candidates, range_of, limit):
+        """The `limit` candidates worth drawing for, best first.
+
+        Ranked by posterior mean plus one standard deviation, so arms
+        with few outcomes still make the cut next to proven ones. Lets
+        callers keep choose() to a handful of draws per decision however
+        many arms there are.
+        """
+        if len(candidates) <= limit:
+            return list(candidates)
+
+        def optimistic(key):
+            good, bad = self.blocks[key]
+            a, b = self._range_prior(range_of(key))
+            a, b = a + good, b + bad
+            n = a + b
+            mean = a / n
+            return mean + (mean * (1 - mean) / (n + 1)) ** 0.5
+
+        return heapq.nlargest(limit, candidates, key=optimistic)
+
+    def range_factors(self, version, count):
+        """A weight per range of one family for steering exploration.
+
+        Ranges with outcomes get a posterior draw, the rest the prior mean.
+        """
+        alpha, beta = self._prior()
+        factors = [alpha / (alpha + beta)] * count
+        for (range_version, index), (good, bad) in self.ranges.items():
+            if range_version == version and index < count:
+                factors[index] = self.rng.betavariate(alpha + good, beta + bad)
+        return factors
+
+    def record(self, good, block_key=None, range_key=None, explored=None):
+        """One probe outcome. `explored` is True/False when the probe's origin is known."""
+        index = 0 if good else 1
+        self.total[index] += 1
+        if explored is True:
+            self.explore[index] += 1
+        if range_key is not None:
+            self.ranges.setdefault(range_key, [0, 0])[index] += 1
+        if block_key is not None:
+            stats = self.blocks.get(block_key)
+            if stats is not None:
+                stats[index] += 1
+            elif good:
+                self.blocks[block_key] = [1, 0]
+
+    def stats(self):
+        return {
+            "arms": len(self.blocks),
+            "ranges": len(self.ranges),
+            "good": self.total[0],
+            "bad": self.total[1],
+            "explore_good": self.explore[0],
+            "explore_bad": self.explore[1]
+        }
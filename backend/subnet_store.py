@@ -0,0 +1,256 @@
+# Copyright (c) 2026 Taher AkbariSaeed
+import heapq
+import json
+import math
+import os
+import time
+from collections import OrderedDict
+
+
+def block_key(version, address):
+    """Packed key of the /24 (IPv4) or /120 (IPv6) holding `address`: block << 1 | is_v6."""
+    return ((address >> 8) << 1) | (version == 6)
+
+def block_version(key):
+    return 6 if key & 1 else 4
+
+def block_start(key):
+    """First address of a packed block."""
+    return (key >> 1) << 8
+
+
+class SubnetStore:
+    """Bounded, decaying scores of blocks that have produced good IPs.
+
+    Each packed block key maps to [score, stamp]; a hit adds to the score
+    and scores halve every `half_life` seconds (applied lazily, on read),
+    so a neighborhood that stopped working fades out on its own. Past
+    `capacity` the lowest decayed scores are evicted, a tenth of the
+    table at a time so adding stays amortised O(1). `version` changes
+    when the set of blocks does, not on every hit. Stamps are wall-clock
+    so a snapshot written by save() ages correctly across restarts.
+    """
+
+    def __init__(self, capacity=4096, half_life=7 * 86400):
+        self.capacity = capacity
+        self.half_life = half_life
+        self.entries = {}  # packed block -> [score, stamp]
+        self.version = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __iter__(self):
+        return iter(list(self.entries))
+
+    def score(self, key, now=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            return 0.0
+        return self._decayed(entry, now or time.time())
+
+    def _decayed(self, entry, now):
+        return entry[0] * math.pow(0.5, max(0.0, now - entry[1]) / self.half_life)
+
+    def add(self, key, weight=1.0, now=None):
+        """Credit a block with a hit."""
+        now = now or time.time()
+        entry = self.entries.get(key)
+        if entry is None:
+            self.entries[key] = [weight, now]
+            self.version += 1
+            if len(self.entries) > self.capacity:
+                self._evict(now)
+        else:
+            entry[0] = self._decayed(entry, now) + weight
+            entry[1] = now
+
+    def seed(self, key, now=None):
+        """Add a block known from elsewhere (e.g. DB history) without crediting it again."""
+        if key not in self.entries:
+            self.add(key, now=now)
+
+    def _evict(self, now):
+        count = len(self.entries) - self.capacity + max(1, self.capacity // 10)
+        # Lowest decayed score first, the least recently credited on ties
+        doomed = heapq.nsmallest(
+            count, self.entries.items(),
+            key=lambda item: (self._decayed(item[1], now), item[1][1])
+        )
+        for key, _ in doomed:
+            del self.entries[key]
+        self.version += 1
+
+    def save(self, path):
+        """Write a snapshot atomically; failures are logged, not raised."""
+        snapshot = {
+            "half_life": self.half_life,
+            "entries": [[key, score, stamp] for key, (score, stamp) in self.entries.items()]
+        }
+        tmp = f"{path}.tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(snapshot, f)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"[SubnetStore] Failed to save {path}: {e}")
+
+    def load(self, path):
+        """Merge a snapshot from save(); returns how many blocks it added."""
+        try:
+            with open(path, "r") as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return 0
+        except (OSError, ValueError) as e:
+            print(f"[SubnetStore] Ignoring unreadable {path}: {e}")
+            return 0
+        now = time.time()
+        added = 0
+        for item in snapshot.get("entries", []):
+            try:
+                key, score, stamp = int(item[0]), float(item[1]), float(item[2])
+            except (TypeError, ValueError, IndexError):
+                continue
+            if key not in self.entries:
+                self.entries[key] = [score, min(stamp, now)]
+                added += 1
+        if added:
+            self.version += 1
+            if len(self.entries) > self.capacity:
+                self._evict(now)
+        return added
+
+
+# Outcomes that count against a block (a failed TCP connect, a foreign certificate),
+# and ones that say nothing about it, e.g. a tunnel that never got through
+DEAD_STATUSES = ('unreachable', 'compromised')
+NEUTRAL_STATUSES = ('timeout', 'error', 'abort', 'tunnel_unreachable')
+
+
+class DeadBlockCache:
+    """Blocks that keep failing on a port, skipped until a TTL runs out.
+
+    Keys are packed ints, block key << 16 | port, with port 0 when the
+    probe used the config's own port. `threshold` dead outcomes in a row
+    mark a block dead on that port for `ttl` seconds. Any sign of life
+    forgets its strikes: a good IP, or a failure such as high ping that
+    needed a working connection. Strike counters are an LRU capped at
+    `capacity`. Expiry times are wall-clock so save()/load() carry them
+    across restarts, together with `ranges_id`, a fingerprint of the range
+    set they were recorded under; follow_ranges() drops everything only
+    when that set actually changes.
+    """
+
+    def __init__(self, threshold=3, ttl=1800, capacity=65536):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.capacity = capacity
+        self.strikes = OrderedDict()  # key -> dead outcomes in a row, below threshold
+        self.dead = {}  # key -> expiry
+        self.ranges_id = None
+
+    def __len__(self):
+        return len(self.dead)
+
+    def is_dead(self, block, port=0, now=None):
+        if not self.dead:
+            return False
+        key = (block << 16) | (port or 0)
+        expiry = self.dead.get(key)
+        if expiry is None:
+            return False
+        if expiry <= (now or time.time()):
+            del self.dead[key]
+            return False
+        return True
+
+    def record(self, block, port, status, now=None):
+        """Count one probe outcome; returns True when it just marked the block dead."""
+        if status in NEUTRAL_STATUSES:
+            return False
+        key = (block << 16) | (port or 0)
+        if status not in DEAD_STATUSES:
+            self.strikes.pop(key, None)
+            self.dead.pop(key, None)
+            return False
+        count = self.strikes.pop(key, 0) + 1
+        if count < self.threshold:
+            self.strikes[key] = count
+            if len(self.strikes) > self.capacity:
+                self.strikes.popitem(last=False)
+            return False
+        now = now or time.time()
+        self.dead[key] = now + self.ttl
+        if len(self.dead) > self.capacity:
+            self._prune(now)
+        return True
+
+    def _prune(self, now):
+        self.dead = {key: expiry for key, expiry in self.dead.items() if expiry > now}
+        if len(self.dead) > self.capacity:
+            # Still full of live entries: keep the ones with the most time left
+            keep = heapq.nlargest(self.capacity, self.dead.items(), key=lambda item: item[1])
+            self.dead = dict(keep)
+
+    def clear(self):
+        self.strikes.clear()
+        self.dead.clear()
+
+    def follow_ranges(self, ranges_id):
+        """Adopt the current range set; returns True if that dropped entries from another one."""
+        changed = self.ranges_id is not None and self.ranges_id != ranges_id
+        if changed:
+            # Blocks judged under the old routing may have moved
+            self.clear()
+        self.ranges_id = ranges_id
+        return changed
+
+    def save(self, path):
+        """Write the unexpired dead blocks atomically; failures are logged, not raised."""
+        now = time.time()
+        snapshot = {
+            "ranges": self.ranges_id,
+            "entries": [[key, expiry] for key, expiry in self.dead.items() if expiry > now]
+        }
+        tmp = f"{path}.tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(snapshot, f)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"[DeadBlockCache] Failed to save {path}: {e}")
+
+    def load(self, path):
+        """Merge unexpired entries from save(); returns how many it added."""
+        try:
+            with open(path, "r") as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return 0
+        except (OSError, ValueError) as e:
+            print(f"[DeadBlockCache] Ignoring unreadable {path}: {e}")
+            return 0
+        ranges_id = snapshot.get("ranges")
+        if self.ranges_id is None:
+            self.ranges_id = ranges_id
+        elif ranges_id is not None and ranges_id != self.ranges_id:
+            # Saved under ranges that have since been replaced
+            return 0
+        now = time.time()
+        added = 0
+        for item in snapshot.get("entries", []):
+            try:
+                key, expiry = int(item[0]), float(item[1])
+            except (TypeError, ValueError, IndexError):
+                continue
+            # A clock that went backwards must not make an entry outlive its TTL
+            if expiry > now and key not in self.dead:
+                self.dead[key] = min(expiry, now + self.ttl)
+                added += 1
+        if len(self.dead) > self.capacity:
+            self._prune(now)
+        return added
@@ -0,0 +1,95 @@
+# Copyright (c) 2026 Taher AkbariSaeed
+import asyncio
+import socket
+import struct
+import time
+
+# Close with RST instead of FIN: a sweep opens thousands of connections a
+# second and would otherwise leave every one of them in TIME_WAIT
+_LINGER_RESET = struct.pack('ii', 1, 0)
+
+
+def fd_budget(wanted):
+    """How many sockets we can keep open at once, raising the soft limit if allowed."""
+    try:
+        import resource
+    except ImportError:
+        return wanted  # Windows: no RLIMIT_NOFILE to speak of
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        target = wanted * 2 + 256
+        if soft != resource.RLIM_INFINITY and soft < target:
+            new_soft = target if hard == resource.RLIM_INFINITY else min(target, hard)
+            resource.setrlimit(resource.RLIMIT_NOFILE, (new_soft, hard))
+            soft = new_soft
+        if soft == resource.RLIM_INFINITY:
+            return wanted
+        # Leave half for Xray cores, tunnel sessions and the API
+        return max(16, min(wanted, soft // 2))
+    except (ValueError, OSError):
+        return wanted
+
+
+class TokenBucket:
+    """Paces callers to `rate` per second, allowing bursts of up to `burst`.
+
+    Each take() books the next free slot, so waiters are spread out instead
+    of all waking on the same tick.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst if burst is not None else max(1, int(rate // 20))
+        self._next = 0.0
+
+    async def take(self):
+        now = time.monotonic()
+        slot = max(self._next, now - self.burst / self.rate)
+        self._next = slot + 1 / self.rate
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+class TcpSweeper:
+    """High-rate TCP connect prober for the pre-filter stage.
+
+    Uses bare non-blocking sockets with loop.sock_connect, so a probe costs
+    one socket and one SYN. Probes are paced to `rate` connects per second
+    and capped at `max_inflight` open sockets (clamped to the fd limit).
+    """
+
+    def __init__(self, rate=5000, timeout=1.0, max_inflight=1024):
+        # A zero or negative rate would stall (or divide by zero in) the bucket
+        self.rate = max(rate, 1)
+        self.timeout = timeout
+        self.max_inflight = fd_budget(max_inflight)
+        self._bucket = TokenBucket(self.rate)
+        self._inflight = asyncio.Semaphore(self.max_inflight)
+        self.stats = {"probed": 0, "open": 0, "started": time.monotonic()}
+
+    async def probe(self, ip, port=443):
+        """Connect RTT in ms, or -1 if the port did not answer in time."""
+        await self._bucket.take()
+        async with self._inflight:
+            self.stats["probed"] += 1
+            loop = asyncio.get_running_loop()
+            sock = socket.socket(socket.AF_INET6 if ':' in ip else socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                sock.setblocking(False)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, _LINGER_RESET)
+                start = time.monotonic()
+                await asyncio.wait_for(loop.sock_connect(sock, (ip, port)), timeout=self.timeout)
+                self.stats["open"] += 1
+                return round((time.monotonic() - start) * 1000, 2)
+            except (OSError, asyncio.TimeoutError):
+                return -1
+            finally:
+                sock.close()
+
+    def rate_stats(self):
+        elapsed = max(time.monotonic() - self.stats["started"], 1e-6)
+        return {
+            "probed": self.stats["probed"],
+            "open": self.stats["open"],
+            "pps": round(self.stats["probed"] / elapsed, 1)
+        }
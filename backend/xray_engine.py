@@ -0,0 +1,517 @@
+# Copyright (c) 2026 Taher AkbariSaeed
+import asyncio
+import contextlib
+import json
+from collections import deque
+import subprocess
+from core_manager import create_child, get_xray_path, spawn_xray, reaper, wait_for_port
+from port_pool import port_pool
+from scanner import generate_xray_config
+
+
+class _Generation:
+    """One running Xray core and the batch of targets it was booted with."""
+
+    def __init__(self, gen_id, process, size, ports):
+        self.gen_id = gen_id
+        self.process = process
+        self.active = size
+        self.ports = ports
+
+
+class XrayLease:
+    """A scan target mapped onto a local socks inbound of a running engine core."""
+
+    def __init__(self, generation, ip, port, local_port, slot=None):
+        self.generation = generation
+        self.ip = ip
+        self.port = port
+        self.local_port = local_port
+        self.slot = slot
+        self.released = False
+
+
+class XrayApiError(Exception):
+    pass
+
+
+class XrayEngine:
+    """Routes many scan targets through a few long-lived Xray cores.
+
+    Every target gets its own socks inbound routed to its own outbound, so
+    run_scan_job can push candidates through without paying a process boot
+    per IP.
+
+    By default a single core is booted with the API inbound enabled and a
+    fixed set of slots (socks inbound + routing rule -> slot outbound). A
+    lease hot-swaps the slot's outbound to the target through the
+    HandlerService (RemoveOutbound/AddOutbound), so the hot path has no
+    config file and no boot wait. Swaps requested within `swap_window` of
+    each other go out as one `rmo`/`ado` pair, so the API CLI boots once
+    per batch rather than twice per target. A failed swap is retried
+    `api_retries` times; if the API stays unusable the engine falls back
+    to batching: targets are collected for a short window and booted
+    together as one core generation, which is torn down once all of its
+    leases are released. The hot-swap core is retired as soon as its
+    remaining leases come back, and acquirers waiting for one of its slots
+    move on to the batched cores. A core that exits is rebooted, and its
+    waiters lease from the new one.
+    """
+
+    def __init__(self, vless_parts, batch_size=32, batch_window=0.15, boot_timeout=5.0,
+                 fragment=None, test_sni=None, advanced_dns_config=None, hot_swap=True,
+                 swap_window=0.02, api_retries=2):
+        self.vless_parts = vless_parts
+        self.hot_swap = hot_swap
+        self.swap_window = swap_window
+        self.api_retries = max(0, api_retries)
+        self.batch_size = max(1, batch_size)
+        self.batch_window = batch_window
+        self.boot_timeout = boot_timeout
+        self.fragment = fragment
+        self.test_sni = test_sni
+        self.advanced_dns_config = advanced_dns_config
+
+        self._pending = []
+        self._wakeup = asyncio.Event()
+        self._flusher = None
+        self._boots = set()
+        self._generations = {}
+        self._next_gen = 0
+        self._closed = False
+
+        # Hot-swap state: one API-enabled core with batch_size slots
+        self._core = None
+        self._core_lock = asyncio.Lock()
+        self._api_port = None
+        self._slot_ports = []
+        self._free_slots = deque()
+        self._slot_waiters = deque()  # futures of acquirers waiting for a free slot
+        self._swaps = []
+        self._swapper = None
+        self.stats = {'generations': 0, 'targets': 0, 'boot_failures': 0, 'swaps': 0, 'api_calls': 0}
+
+    def _target_outbound(self, ip, port, tag):
+        cfg = generate_xray_config(
+            self.vless_parts, ip, 0, test_port=port, fragment=self.fragment,
+            test_sni=self.test_sni, advanced_dns_config=self.advanced_dns_config
+        )
+        outbound = cfg["outbounds"][0]
+        outbound["tag"] = tag
+        return outbound
+
+    def build_config(self, targets):
+        """Build one multi-inbound core config for a list of (ip, port, local_port) targets."""
+        base = None
+        inbounds = []
+        outbounds = []
+        rules = []
+        for i, (ip, port, local_port) in enumerate(targets):
+            cfg = generate_xray_config(
+                self.vless_parts, ip, local_port, test_port=port, fragment=self.fragment,
+                test_sni=self.test_sni, advanced_dns_config=self.advanced_dns_config
+            )
+            if base is None:
+                base = cfg
+            inbound = cfg["inbounds"][0]
+            inbound["listen"] = "127.0.0.1"
+            inbound["tag"] = f"in-{i}"
+            outbound = cfg["outbounds"][0]
+            outbound["tag"] = f"out-{i}"
+            inbounds.append(inbound)
+            outbounds.append(outbound)
+            rules.append({"type": "field", "inboundTag": [f"in-{i}"], "outboundTag": f"out-{i}"})
+
+        # Helper outbounds (fragment dialer, dns-out) are identical for every target
+        outbounds.extend(base["outbounds"][1:])
+        config = {
+            "log": base["log"],
+            "inbounds": inbounds,
+            "outbounds": outbounds,
+            "routing": {
+                "domainStrategy": "AsIs",
+                "rules": base.get("routing", {}).get("rules", []) + rules
+            }
+        }
+        if "dns" in base:
+            config["dns"] = base["dns"]
+        return config
+
+    def build_slot_config(self, slot_ports, api_port):
+        """Build the API-enabled core config: idle slots whose outbounds are swapped at runtime."""
+        base = generate_xray_config(
+            self.vless_parts, "127.0.0.1", 0, fragment=self.fragment,
+            test_sni=self.test_sni, advanced_dns_config=self.advanced_dns_config
+        )
+        inbounds = [{
+            "listen": "127.0.0.1",
+            "port": api_port,
+            "protocol": "dokodemo-door",
+            "settings": {"address": "127.0.0.1"},
+            "tag": "api"
+        }]
+        outbounds = [{"protocol": "blackhole", "tag": "idle"}]
+        rules = [{"type": "field", "inboundTag": ["api"], "outboundTag": "api"}]
+        rules.extend(base.get("routing", {}).get("rules", []))
+        for i, local_port in enumerate(slot_ports):
+            inbound = dict(base["inbounds"][0], listen="127.0.0.1", port=local_port, tag=f"in-{i}")
+            inbounds.append(inbound)
+            outbounds.append({"protocol": "blackhole", "tag": f"out-{i}"})
+            rules.append({"type": "field", "inboundTag": [f"in-{i}"], "outboundTag": f"out-{i}"})
+
+        # Helper outbounds (fragment dialer, dns-out) are shared by every slot
+        outbounds.extend(base["outbounds"][1:])
+        config = {
+            "log": base["log"],
+            "api": {"tag": "api", "services": ["HandlerService", "RoutingService"]},
+            "inbounds": inbounds,
+            "outbounds": outbounds,
+            "routing": {"domainStrategy": "AsIs", "rules": rules}
+        }
+        if "dns" in base:
+            config["dns"] = base["dns"]
+        return config
+
+    async def acquire(self, ip, port=None):
+        """Map a target onto a live local socks inbound and return its lease."""
+        if self._closed:
+            raise RuntimeError("Xray engine is closed")
+        if self.hot_swap:
+            try:
+                lease = await self._acquire_slot(ip, port)
+            except XrayApiError as e:
+                if self.hot_swap:
+                    print(f"[XrayEngine] API hot-swap unavailable, falling back to batched cores: {e}")
+                    self.hot_swap = False
+                    # Parked acquirers follow this one to the batched cores
+                    self._wake_slot_waiters()
+                    self._retire_idle_core()
+            else:
+                if lease is not None:
+                    return lease
+        return await self._acquire_batched(ip, port)
+
+    async def _acquire_batched(self, ip, port):
+        """Queue a target for the next core generation and wait until its socks inbound is live."""
+        fut = asyncio.get_running_loop().create_future()
+        self._pending.append((ip, port, fut))
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_loop())
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+        try:
+            return await fut
+        except asyncio.CancelledError:
+            # Cancelled after the lease was handed over but before we resumed
+            if fut.done() and not fut.cancelled() and fut.exception() is None:
+                self.release(fut.result())
+            raise
+
+    async def _acquire_slot(self, ip, port):
+        """Lease a hot-swap slot; None if the engine switched to batched cores meanwhile."""
+        for attempt in range(3):
+            if self._closed:
+                raise RuntimeError("Xray engine is closed")
+            core = await self._ensure_core()
+            slot = await self._take_slot()
+            if not self.hot_swap:
+                self._put_slot(core, slot)
+                return None
+            if slot is None or core is not self._core:
+                # The core was replaced while we waited: lease from the new one
+                self._put_slot(core, slot)
+                continue
+            try:
+                return await self._swap_in(core, slot, ip, port)
+            except XrayApiError:
+                if core.process.returncode is None or attempt == 2:
+                    raise
+                # The core died under the swap; the next pass reboots it
+        raise XrayApiError("hot-swap core keeps exiting")
+
+    async def _take_slot(self):
+        """A free slot of the current core, or None if the core went away while waiting."""
+        if self._free_slots:
+            return self._free_slots.popleft()
+        fut = asyncio.get_running_loop().create_future()
+        self._slot_waiters.append(fut)
+        try:
+            return await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled() and fut.result() is not None:
+                # Handed a slot after the caller gave up
+                self._put_slot(self._core, fut.result())
+            raise
+
+    async def _swap_in(self, core, slot, ip, port):
+        fut = asyncio.get_running_loop().create_future()
+        self._swaps.append((core, slot, self._target_outbound(ip, port, f"out-{slot}"), fut))
+        if self._swapper is None or self._swapper.done():
+            self._swapper = asyncio.create_task(self._swap_loop())
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # Settled after the caller gave up: the slot is simply free again
+                self._put_slot(core, slot)
+            else:
+                # The swap loop frees the slot of a cancelled entry
+                fut.cancel()
+            raise
+        except BaseException:
+            self._put_slot(core, slot)
+            raise
+        self.stats['targets'] += 1
+        return XrayLease(core, ip, port, self._slot_ports[slot], slot=slot)
+
+    async def _swap_loop(self):
+        """Push queued slot swaps to the core, one rmo/ado pair per batch."""
+        while self._swaps and not self._closed:
+            await asyncio.sleep(self.swap_window)
+            batch = []
+            for core, slot, outbound, fut in self._swaps:
+                if fut.done():
+                    self._put_slot(core, slot)
+                else:
+                    batch.append((core, slot, outbound, fut))
+            self._swaps.clear()
+            if not batch:
+                continue
+
+            tags = [outbound["tag"] for _, _, outbound, _ in batch]
+            payload = {"outbounds": [outbound for _, _, outbound, _ in batch]}
+            error = None
+            for attempt in range(self.api_retries + 1):
+                try:
+                    if attempt:
+                        # A failed ado may have left some tags added and others missing,
+                        # and rmo stops at the first unknown tag: clear them one by one
+                        await asyncio.sleep(0.1 * attempt)
+                        for tag in tags:
+                            await self._api("rmo", tag, check=False)
+                    else:
+                        # RemoveOutbound fails harmlessly if a slot still holds its placeholder
+                        await self._api("rmo", *tags, check=False)
+                    await self._api("ado", payload=payload)
+                    error = None
+                    break
+                except XrayApiError as e:
+                    error = e
+            for core, slot, _, fut in batch:
+                if fut.done():
+                    # Caller gave up while the swap was in flight
+                    self._put_slot(core, slot)
+                    continue
+                if error is None:
+                    fut.set_result(None)
+                else:
+                    fut.set_exception(error)
+            if error is None:
+                self.stats['swaps'] += len(batch)
+
+    async def _ensure_core(self):
+        async with self._core_lock:
+            if self._core is not None and self._core.process.returncode is None:
+                return self._core
+            if self._core is not None:
+                print("[XrayEngine] Hot-swap core exited, rebooting")
+                self._drop_core()
+
+            gen_id = self._next_gen
+            self._next_gen += 1
+            ports = []
+            try:
+                ports = port_pool.reserve_many(self.batch_size + 1)
+                self._api_port, self._slot_ports = ports[0], ports[1:]
+                config = self.build_slot_config(self._slot_ports, self._api_port)
+                process = await spawn_xray(config, label="engine core", persistent=True)
+            except asyncio.CancelledError:
+                port_pool.release_many(ports, quarantine=0)
+                raise
+            except Exception as e:
+                port_pool.release_many(ports, quarantine=0)
+                raise XrayApiError(f"could not start core: {e}")
+
+            core = _Generation(gen_id, process, 0, ports)
+            self._generations[gen_id] = core
+            self.stats['generations'] += 1
+            if not await self._wait_listening(process, ports):
+                self.stats['boot_failures'] += 1
+                self._retire(core)
+                raise XrayApiError("core failed to boot")
+
+            self._free_slots = deque(range(len(self._slot_ports)))
+            self._core = core
+            # Acquirers parked on the old core's slots can take the new ones
+            while self._slot_waiters and self._free_slots:
+                waiter = self._slot_waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(self._free_slots.popleft())
+            return core
+
+    async def _api(self, command, *args, payload=None, check=True):
+        """Run `xray api <command>` against the hot-swap core, feeding JSON payloads over stdin."""
+        self.stats['api_calls'] += 1
+        try:
+            proc = await create_child(
+                get_xray_path(), "api", command, f"--server=127.0.0.1:{self._api_port}", *args,
+                stdin=subprocess.PIPE if payload is not None else subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+            )
+        except Exception as e:
+            raise XrayApiError(f"api {command}: {e}")
+        data = json.dumps(payload, separators=(',', ':')).encode() if payload is not None else None
+        try:
+            _, err = await asyncio.wait_for(proc.communicate(data), timeout=self.boot_timeout)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            raise XrayApiError(f"api {command}: timed out")
+        if check and proc.returncode != 0:
+            raise XrayApiError(f"api {command}: {err.decode(errors='replace').strip()[:200]}")
+
+    def release(self, lease):
+        if lease is None or lease.released:
+            return
+        lease.released = True
+        if lease.slot is not None:
+            self._put_slot(lease.generation, lease.slot)
+            return
+        gen = lease.generation
+        gen.active -= 1
+        if gen.active <= 0:
+            self._retire(gen)
+
+    def _put_slot(self, core, slot):
+        # Stale leases from a crashed core must not refill the new core's slots
+        if slot is None or core is None or core is not self._core:
+            return
+        if core.process.returncode is not None:
+            # The core died under its leases: parked acquirers reboot it
+            print("[XrayEngine] Hot-swap core exited")
+            self._drop_core()
+            return
+        if self.hot_swap:
+            while self._slot_waiters:
+                waiter = self._slot_waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(slot)
+                    return
+        self._free_slots.append(slot)
+        if not self.hot_swap:
+            self._retire_idle_core()
+
+    def _wake_slot_waiters(self):
+        # None tells a parked acquirer its core is gone; it re-checks hot_swap
+        while self._slot_waiters:
+            waiter = self._slot_waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def _drop_core(self):
+        if self._core is not None:
+            self._retire(self._core)
+        self._core = None
+        self._free_slots.clear()
+        self._wake_slot_waiters()
+
+    def _retire_idle_core(self):
+        """Shut the hot-swap core down once every slot is back (after falling back)."""
+        if self._core is None or len(self._free_slots) < len(self._slot_ports):
+            return
+        self._drop_core()
+
+    @contextlib.asynccontextmanager
+    async def target(self, ip, port=None):
+        lease = await self.acquire(ip, port)
+        try:
+            yield lease
+        finally:
+            self.release(lease)
+
+    async def close(self):
+        self._closed = True
+        for _, _, fut in self._pending:
+            if not fut.done():
+                fut.set_exception(RuntimeError("Xray engine is closed"))
+        self._pending.clear()
+        for _, _, _, fut in self._swaps:
+            if not fut.done():
+                fut.set_exception(RuntimeError("Xray engine is closed"))
+        self._swaps.clear()
+        for task in list(self._boots):
+            task.cancel()
+        for gen in list(self._generations.values()):
+            self._retire(gen)
+        self._free_slots.clear()
+        self._wake_slot_waiters()
+        self._core = None
+
+    async def _flush_loop(self):
+        while self._pending and not self._closed:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.batch_window)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            batch = [p for p in self._pending[:self.batch_size] if not p[2].done()]
+            del self._pending[:self.batch_size]
+            if len(self._pending) >= self.batch_size:
+                self._wakeup.set()
+            if batch:
+                task = asyncio.create_task(self._boot_generation(batch))
+                self._boots.add(task)
+                task.add_done_callback(self._boots.discard)
+
+    async def _boot_generation(self, batch):
+        gen_id = self._next_gen
+        self._next_gen += 1
+        local_ports = []
+        gen = None
+        ready = False
+        try:
+            local_ports = port_pool.reserve_many(len(batch))
+            targets = [(ip, port, lp) for (ip, port, _), lp in zip(batch, local_ports)]
+            config = self.build_config(targets)
+            process = await spawn_xray(config, label=f"engine generation {gen_id}", persistent=True)
+            gen = _Generation(gen_id, process, len(batch), local_ports)
+            self._generations[gen_id] = gen
+            self.stats['generations'] += 1
+
+            ready = await self._wait_listening(process, local_ports)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f"[XrayEngine] Failed to boot core generation {gen_id}: {e}")
+
+        if not ready:
+            self.stats['boot_failures'] += 1
+            if gen:
+                self._retire(gen)
+            else:
+                port_pool.release_many(local_ports, quarantine=0)
+            for _, _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(RuntimeError("Xray engine core failed to boot"))
+            return
+
+        for (ip, port, fut), lp in zip(batch, local_ports):
+            if fut.done():
+                # Caller gave up while the core was booting
+                gen.active -= 1
+            else:
+                self.stats['targets'] += 1
+                fut.set_result(XrayLease(gen, ip, port, lp))
+        if gen.active <= 0:
+            self._retire(gen)
+
+    async def _wait_listening(self, process, ports):
+        ready = await asyncio.gather(*[wait_for_port(p, process=process, timeout=self.boot_timeout) for p in ports])
+        return all(ready)
+
+    def _retire(self, gen):
+        if self._generations.pop(gen.gen_id, None) is None:
+            return
+        reaper.reap(gen.process)
+        port_pool.release_many(gen.ports)
@@ -20,10 +20,27 @@ import LanguageSwitcher from './components/LanguageSwitcher';
 import { useTranslation } from './i18n/LanguageContext';
 import { Toaster, toast } from 'react-hot-toast';
 import logoImg from '/logo.png';
-import { scanIPs, getScanStatus, logUsage, scanAdvancedIPs, pauseScan, resumeScan, stopScan } from './api';
+import { scanIPs, getScanStatus, openScanEvents, logUsage, scanAdvancedIPs, pauseScan, resumeScan, stopScan } from './api';
 
 const APP_VERSION = typeof __APP_VERSION__ !== 'undefined' ? __APP_VERSION__ : '0.0.0';
 
+// New results merged into the ping-sorted list. The scan cursor delivers each
+// result once, and the same IP can legitimately repeat (other ports or configs)
+const mergeResults = (current, incoming) => {
+  if (incoming.length === 0) return current;
+  return [...current, ...incoming].sort((a, b) => (a.ping ?? 9999) - (b.ping ?? 9999));
+};
+
+// Stats events only carry what changed; nested objects change key by key
+const applyStatsDelta = (status, delta) => {
+  if (!status) return status;
+  const next = { ...status };
+  for (const [key, value] of Object.entries(delta)) {
+    next[key] = value && typeof value === 'object' && !Array.isArray(value) ? { ...(status[key] || {}), ...value } : value;
+  }
+  return next;
+};
+
 function App() {
   const [scanId, setScanId] = useState(null);
   const [results, setResults] = useState([]);
@@ -147,67 +164,139 @@ function App() {
 
   useEffect(() => {
     let interval;
-    if (scanId && isScanning) {
-      interval = setInterval(async () => {
-        try {
-          const data = await getScanStatus(scanId);
-          if (data.results) {
+    let socket = null;
+    let active = true;
+    // After the first full poll each one only fetches what is new
+    let cursor = null;
+    let logs = [];
+    let polling = false;
+    let pollAgain = false;
+    const poll = async () => {
+      if (polling) {
+        // e.g. 'end' arrived mid-poll: fetch once more when this one is done
+        pollAgain = true;
+        return;
+      }
+      polling = true;
+      try {
+        const data = await getScanStatus(scanId, cursor);
+        if (data.cursor) {
+          cursor = data.cursor;
+        }
+        if (data.results) {
+          if (!data.incremental) {
             setResults(data.results);
+          } else if (data.results.length > 0) {
+            setResults(prev => mergeResults(prev, data.results));
+          }
+        }
+        if (data.status) {
+          if (data.incremental) {
+            logs = [...logs, ...data.status.logs].slice(-100);
+            data.status.logs = logs;
+          } else {
+            logs = data.status.logs || [];
           }
-          if (data.status) {
-            setStatus(data.status);
-            if (data.status.status === 'completed' || data.status.status === 'stopped') {
-              setIsScanning(false);
-              clearInterval(interval);
-
-              // Smart Fallback Retry Logic
-              const isAutoScan = currentScanSettings.current?.ipSource === 'smart_history' || currentScanSettings.current?.ipSource === 'gold_ips';
-              if (data.status.status === 'completed' && data.status.found_good === 0 && isAutoScan && retryCount.current < 2) {
-                retryCount.current += 1;
-
-                setIsScanning(true);
-
-                // Relax constraints heavily to bypass censorship
-                const relaxedSettings = { ...currentScanSettings.current };
-                relaxedSettings.maxPing = Math.min((relaxedSettings.maxPing || 1000) + 1500, 4000);
-                relaxedSettings.maxJitter = Math.min((relaxedSettings.maxJitter || 300) + 1000, 2000);
-                relaxedSettings.minDown = 0; // completely disable speed limits on retry
-                relaxedSettings.minUp = 0;
-                currentScanSettings.current = relaxedSettings;
-
-                setTimeout(async () => {
-                  try {
-                    const res = await scanIPs({
-                      vless_config: currentVlessConfig.current,
-                      ip_count: 50,
-                      manual_ips: currentManualIps.current,
-                      stop_after: relaxedSettings.stopAfter,
-                      concurrency: relaxedSettings.concurrency,
-                      max_ping: relaxedSettings.maxPing,
-                      max_jitter: relaxedSettings.maxJitter,
-                      min_download: relaxedSettings.minDown,
-                      min_upload: relaxedSettings.minUp,
-                      ip_version: relaxedSettings.ipVersion,
-                      ip_source: relaxedSettings.ipSource,
-                      custom_url: relaxedSettings.customUrl,
-                      use_system_proxy: useSystemProxy
-                    });
-                    if (res.scan_id) {
-                      setScanId(res.scan_id);
-                    } else {
-                      setIsScanning(false);
-                    }
-                  } catch (e) { setIsScanning(false); }
-                }, 2000);
-              }
+          setStatus(data.status);
+          if (data.status.status === 'completed' || data.status.status === 'stopped') {
+            setIsScanning(false);
+            clearInterval(interval);
+
+            // Smart Fallback Retry Logic
+            const isAutoScan = currentScanSettings.current?.ipSource === 'smart_history' || currentScanSettings.current?.ipSource === 'gold_ips';
+            if (data.status.status === 'completed' && data.status.found_good === 0 && isAutoScan && retryCount.current < 2) {
+              retryCount.current += 1;
+
+              setIsScanning(true);
+
+              // Relax constraints heavily to bypass censorship
+              const relaxedSettings = { ...currentScanSettings.current };
+              relaxedSettings.maxPing = Math.min((relaxedSettings.maxPing || 1000) + 1500, 4000);
+              relaxedSettings.maxJitter = Math.min((relaxedSettings.maxJitter || 300) + 1000, 2000);
+              relaxedSettings.minDown = 0; // completely disable speed limits on retry
+              relaxedSettings.minUp = 0;
+              currentScanSettings.current = relaxedSettings;
+
+              setTimeout(async () => {
+                try {
+                  const res = await scanIPs({
+                    vless_config: currentVlessConfig.current,
+                    ip_count: 50,
+                    manual_ips: currentManualIps.current,
+                    stop_after: relaxedSettings.stopAfter,
+                    concurrency: relaxedSettings.concurrency,
+                    max_ping: relaxedSettings.maxPing,
+                    max_jitter: relaxedSettings.maxJitter,
+                    min_download: relaxedSettings.minDown,
+                    min_upload: relaxedSettings.minUp,
+                    ip_version: relaxedSettings.ipVersion,
+                    ip_source: relaxedSettings.ipSource,
+                    custom_url: relaxedSettings.customUrl,
+                    use_system_proxy: useSystemProxy
+                  });
+                  if (res.scan_id) {
+                    setScanId(res.scan_id);
+                  } else {
+                    setIsScanning(false);
+                  }
+                } catch (e) { setIsScanning(false); }
+              }, 2000);
             }
           }
-        } catch (e) {
-          console.error("Polling error", e);
         }
-      }, 1000);
+      } catch (e) {
+        console.error("Polling error", e);
+      } finally {
+        polling = false;
+        if (pollAgain && active) {
+          pollAgain = false;
+          poll();
+        }
+      }
+    };
+    // Polling is the fallback for when the live event stream is unavailable
+    const startPolling = () => {
+      if (active && !interval) {
+        cursor = null;
+        interval = setInterval(poll, 1000);
+      }
+    };
+    const onEvent = (event) => {
+      switch (event.type) {
+        case 'log':
+          logs = [...logs, event.data].slice(-100);
+          setStatus(prev => prev ? { ...prev, logs } : prev);
+          break;
+        case 'result':
+          setResults(prev => mergeResults(prev, [event.data]));
+          break;
+        case 'stats':
+          setStatus(prev => applyStatsDelta(prev, event.data));
+          break;
+        case 'status':
+          setStatus(prev => prev ? { ...prev, status: event.data } : prev);
+          break;
+        case 'resync':
+        case 'end':
+          // One full fetch; at the end poll() also runs the completion handling
+          cursor = null;
+          poll();
+          break;
+        default:
+          break;
+      }
+    };
+    if (scanId && isScanning) {
+      poll();
+      socket = openScanEvents(`/scan/${scanId}/events`, onEvent, (ended) => {
+        if (!ended) startPolling();
+      });
     }
-    return () => clearInterval(interval);
+    return () => {
+      active = false;
+      clearInterval(interval);
+      if (socket) socket.close();
+    };
   }, [scanId, isScanning, useSystemProxy]);
 
   const { t } = useTranslation();
@@ -19,11 +19,35 @@ export const exportSubscription = async (format, vlessConfig, ips) => {
     return response.json();
 };
 
-export const getScanStatus = async (scanId) => {
-    const response = await fetch(`${API_URL}/scan/${scanId}`);
+export const getScanStatus = async (scanId, cursor = null) => {
+    // With a cursor the backend only returns results and logs added since
+    const query = cursor ? `?since=${cursor.since}&logs_since=${cursor.logs_since}` : '';
+    const response = await fetch(`${API_URL}/scan/${scanId}${query}`);
     return response.json();
 };
 
+// Live scan events (log, result, stats, status, resync, end) pushed over a WebSocket.
+// onClose(ended) tells whether the stream finished normally or dropped.
+export const openScanEvents = (path, onEvent, onClose) => {
+    let ended = false;
+    let socket;
+    try {
+        socket = new WebSocket(`${API_URL.replace(/^http/, 'ws')}${path}`);
+    } catch (e) {
+        onClose(false);
+        return null;
+    }
+    socket.onmessage = (msg) => {
+        const payload = JSON.parse(msg.data);
+        for (const event of payload.events || []) {
+            if (event.type === 'end') ended = true;
+            onEvent(event);
+        }
+    };
+    socket.onclose = () => onClose(ended);
+    return socket;
+};
+
 export const getSettings = async () => {
     try {
         const response = await fetch(`${API_URL}/settings`);
@@ -1,6 +1,6 @@
 /* Copyright (c) 2026 Taher AkbariSaeed */
 import React, { useState, useEffect } from 'react';
-import { scanWarpIPs, getWarpScanStatus, stopWarpScan } from '../api';
+import { scanWarpIPs, getWarpScanStatus, stopWarpScan, openScanEvents } from '../api';
 import { useTranslation } from '../i18n/LanguageContext';
 import { toast } from 'react-hot-toast';
 
@@ -62,27 +62,50 @@ export default function WarpScanner() {
 
     useEffect(() => {
         let interval;
-        if (scanId && status === 'running') {
-            interval = setInterval(async () => {
-                try {
-                    const data = await getWarpScanStatus(scanId);
-                    if (data.status) {
-                        setMetrics({
-                            completed: data.status.completed,
-                            found: data.status.found_good
-                        });
-                        setLogs(data.status.logs || []);
-                        if (data.status.status !== 'running') {
-                            setStatus(data.status.status);
-                        }
-                    }
-                    if (data.results) {
-                        setResults(data.results);
+        let socket = null;
+        let active = true;
+        const poll = async () => {
+            try {
+                const data = await getWarpScanStatus(scanId);
+                if (data.status) {
+                    setMetrics({
+                        completed: data.status.completed,
+                        found: data.status.found_good
+                    });
+                    setLogs(data.status.logs || []);
+                    if (data.status.status !== 'running') {
+                        setStatus(data.status.status);
                     }
-                } catch (e) { }
-            }, 1000);
+                }
+                if (data.results) {
+                    setResults(data.results);
+                }
+            } catch (e) { }
+        };
+        if (scanId && status === 'running') {
+            // Live events, with polling as the fallback if the stream drops
+            socket = openScanEvents(`/scan-warp/${scanId}/events`, (event) => {
+                if (event.type === 'log') {
+                    setLogs(prev => [...prev, event.data]);
+                } else if (event.type === 'result') {
+                    setResults(prev => [...prev, event.data]);
+                } else if (event.type === 'stats') {
+                    setMetrics(prev => ({
+                        completed: event.data.completed ?? prev.completed,
+                        found: event.data.found_good ?? prev.found
+                    }));
+                } else if (event.type === 'resync' || event.type === 'end' || (event.type === 'status' && event.data !== 'running')) {
+                    poll();
+                }
+            }, (ended) => {
+                if (active && !ended && !interval) interval = setInterval(poll, 1000);
+            });
         }
-        return () => clearInterval(interval);
+        return () => {
+            active = false;
+            clearInterval(interval);
+            if (socket) socket.close();
+        };
     }, [scanId, status]);
 
     const copyAllEndpoints = () => {